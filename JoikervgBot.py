@@ -8,6 +8,7 @@ import signal
 
 from sopel.__init__ import run
 from sopel.config import Config, create_config, ConfigurationError, wizard
+from sopel.db import SopelDB, migrate
 import sopel.tools as tools
 from sopel.tools import stderr
 
@@ -70,6 +71,8 @@ def main(argv=None):
             dest='mod_wizard', help='Run the configuration wizard, but only for the module configuration options.')
         parser.add_option('--configure-database', action='store_true',
             dest='db_wizard', help='Run the configuration wizard, but only for the database configuration options.')
+        parser.add_option('--migrate-db', metavar='filename',
+            dest='migrate_db', help='Copy the settings database into the one configured in the given configuration file, then exit.')
         opts, args = parser.parse_args(argv)
 
         if opts.wizard:
@@ -114,6 +117,21 @@ def main(argv=None):
             # exit with code 2 to prevent auto restart on fail by systemd
             sys.exit(2)
 
+        if opts.migrate_db:
+            try:
+                target_config = Config(find_config(opts.migrate_db))
+            except ConfigurationError as e:
+                stderr(e)
+                sys.exit(2)
+            source_db = SopelDB(config_module)
+            target_db = SopelDB(target_config)
+            if not source_db or not target_db:
+                stderr(u'Both configuration files need a working [db] section.')
+                sys.exit(2)
+            if not migrate(source_db, target_db):
+                sys.exit(1)
+            return
+
         if not config_module.has_option('core', 'homedir'):
             config_module.dotdir = homedir
             config_module.homedir = homedir
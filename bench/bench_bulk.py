@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+bench_bulk.py - Compare Table.get_many and Table.update_many to per-row calls
+Licensed under the Eiffel Forum License 2.
+
+Fills a sqlite table with ``--rows`` rows, then times reading them all with a
+``get`` loop and with one ``get_many``, and updating and inserting
+``--writes`` rows with an ``update`` loop and with one ``update_many``.
+Each figure is the best of ``--repeat`` runs. Run it from the repository root:
+
+    python bench/bench_bulk.py --rows 5000 --writes 1000
+
+The database goes in a temporary directory unless ``--dir`` is given, which
+is the place to point at a tmpfs or a real disk to see how fsync weighs in.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sopel.config import Config
+from sopel.db import SopelDB
+
+
+def open_db(directory):
+    path = os.path.join(directory, 'bench.cfg')
+    with open(path, 'w') as cfg:
+        cfg.write('[core]\nnick = Sopel\nowner = Owner\nhost = localhost\n'
+                  '[db]\nuserdb_type = sqlite\nuserdb_file = %s\n'
+                  % os.path.join(directory, 'bench.db'))
+    return SopelDB(Config(path))
+
+
+def best(repeat, setup, func):
+    times = []
+    for _ in xrange(repeat):
+        setup()
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--writes', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        db = open_db(directory)
+        db.add_table('prefs', ['name', 'tz'], 'name')
+        table = db.prefs
+        names = [u'nick%d' % i for i in xrange(args.rows)]
+        table.update_many(dict((name, {'tz': u'UTC'}) for name in names))
+        writes = names[:args.writes]
+        new = [u'new%d' % i for i in xrange(args.writes)]
+
+        def nothing():
+            pass
+
+        def drop_new():
+            with db.transaction() as conn:
+                conn.cursor().execute(
+                    "DELETE FROM prefs WHERE name LIKE 'new%'")
+
+        def get_loop():
+            for name in names:
+                table.get(name, 'tz')
+
+        def update_loop(rows):
+            def run():
+                for name in rows:
+                    table.update(name, {'tz': u'CET'})
+            return run
+
+        def update_many(rows):
+            def run():
+                table.update_many(dict((name, {'tz': u'CET'})
+                                       for name in rows))
+            return run
+
+        results = [
+            ('read %d rows' % args.rows,
+             best(args.repeat, nothing, get_loop),
+             best(args.repeat, nothing,
+                  lambda: table.get_many(names, 'tz'))),
+            ('update %d rows' % args.writes,
+             best(args.repeat, nothing, update_loop(writes)),
+             best(args.repeat, nothing, update_many(writes))),
+            ('insert %d rows' % args.writes,
+             best(args.repeat, drop_new, update_loop(new)),
+             best(args.repeat, drop_new, update_many(new))),
+        ]
+        for label, loop, bulk in results:
+            print '%-18s per-row loop %.3fs   bulk %.3fs   %.0fx' % (
+                label, loop, bulk, loop / bulk if bulk else float('inf'))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# coding=utf-8
+"""
+bench_cap.py - Time capability negotiation against a flood-limited server
+Licensed under the Eiffel Forum License 2.
+
+Starts a stand-in IRC server on localhost which answers ``CAP`` and SASL
+``AUTHENTICATE`` lines after ``--latency`` seconds each way. Like most
+networks, it lets the client send a burst of five lines, then only one every
+``--pace`` seconds. The CAP handlers from ``coretasks`` negotiate with it, and
+the time from connecting to ``001`` is reported, with the lines sent.
+
+    python bench/bench_cap.py --latency 0.05 --pace 2
+
+``--compare REV`` also runs the ``coretasks.py`` of git revision ``REV``.
+Code from before ``CAP LS 302`` must be compared with ``--old-ls``, which
+makes the client send a plain ``CAP LS`` for it.
+"""
+
+import argparse
+import os
+import Queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from sopel import coretasks
+from sopel.isupport import ISupport
+from sopel.tools import Nick
+
+CAPS = ('account-notify away-notify extended-join multi-prefix '
+        'userhost-in-names sasl=PLAIN,EXTERNAL cap-notify chghost '
+        'invite-notify server-time message-tags batch echo-message '
+        'labeled-response account-tag')
+BURST = 5
+
+
+def serve(conn, latency, pace, stats):
+    """Answer one client until it is welcomed."""
+    lines = conn.makefile('rb')
+    queue = Queue.Queue()
+
+    def sender():
+        while True:
+            due, line = queue.get()
+            if line is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            conn.sendall(line + '\r\n')
+    thread = threading.Thread(target=sender)
+    thread.start()
+
+    def reply(line):
+        # There and back again.
+        queue.put((time.time() + 2 * latency, line))
+
+    known = set(cap.split('=')[0] for cap in CAPS.split())
+    nick = None
+    user = ended = False
+    tokens = BURST
+    last = time.time()
+    while True:
+        line = lines.readline()
+        if not line:
+            break
+        stats['lines'] += 1
+        now = time.time()
+        if pace:
+            tokens = min(BURST, tokens + (now - last) / pace)
+            if tokens < 1:
+                time.sleep((1 - tokens) * pace)
+                tokens = 1
+        last = time.time()
+        tokens -= 1
+
+        words, _, text = line.rstrip('\r\n').partition(' :')
+        words = words.split()
+        target = nick or '*'
+        if words[0] == 'CAP' and words[1] == 'LS':
+            if len(words) > 2:
+                reply(':srv CAP %s LS :%s' % (target, CAPS))
+            else:
+                reply(':srv CAP %s LS :%s' % (target, ' '.join(known)))
+        elif words[0] == 'CAP' and words[1] == 'REQ':
+            stats['reqs'] += 1
+            wanted = (text or words[2]).split()
+            if all(cap.lstrip('-') in known for cap in wanted):
+                reply(':srv CAP %s ACK :%s' % (target, ' '.join(wanted)))
+            else:
+                reply(':srv CAP %s NAK :%s' % (target, ' '.join(wanted)))
+        elif words[0] == 'CAP' and words[1] == 'END':
+            ended = True
+        elif words[0] == 'NICK':
+            nick = words[1]
+        elif words[0] == 'USER':
+            user = True
+        elif words[0] == 'AUTHENTICATE':
+            if words[1] == 'PLAIN':
+                reply('AUTHENTICATE +')
+            else:
+                reply(':srv 903 %s :SASL authentication successful' % nick)
+        if ended and nick and user:
+            reply(':srv 001 %s :Welcome' % nick)
+            break
+    queue.put((None, None))
+    thread.join()
+
+
+class FakeBot(object):
+    """Just what the CAP handlers use of a ``Sopel``."""
+
+    class config(object):
+        class core(object):
+            sasl_password = 'secret'
+            sasl_mechanism = None
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.nick = Nick('Sopel')
+        self.isupport = ISupport()
+        self.server_capabilities = set()
+        self.enabled_capabilities = set()
+        self._cap_reqs = {}
+        self._cap_ls_done = False
+        self._cap_pending = set()
+
+    def write(self, args, text=None):
+        line = ' '.join(args)
+        if text is not None:
+            line += ' :' + text
+        self.sock.sendall(line + '\r\n')
+
+    def debug(self, *args):
+        pass
+
+
+class FakeTrigger(unicode):
+    pass
+
+
+def negotiate(handlers, ls, latency, pace):
+    """Connect to a new stand-in server, and return the time to 001."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    stats = {'lines': 0, 'reqs': 0}
+
+    def accept():
+        conn, _ = listener.accept()
+        serve(conn, latency, pace, stats)
+        conn.close()
+    server = threading.Thread(target=accept)
+    server.start()
+
+    sock = socket.create_connection(listener.getsockname())
+    bot = FakeBot(sock)
+    started = time.time()
+    bot.write(ls)
+    bot.write(('NICK', bot.nick))
+    bot.write(('USER', 'sopel', '+iw', bot.nick), 'Sopel')
+    lines = sock.makefile('rb')
+    while True:
+        words, _, text = lines.readline().rstrip('\r\n').partition(' :')
+        words = words.split()
+        if words[0].startswith(':'):
+            words = words[1:]
+        args = words[1:]
+        if text:
+            args.append(text)
+        trigger = FakeTrigger(args[-1] if args else '')
+        trigger.args = args
+        if words[0] == '001':
+            break
+        handler = handlers.get(words[0])
+        if handler:
+            handler(bot, trigger)
+    elapsed = time.time() - started
+    sock.close()
+    listener.close()
+    server.join()
+    return elapsed, stats
+
+
+def load_revision(rev):
+    source = subprocess.check_output(['git', '-C', ROOT, 'show',
+                                      rev + ':sopel/coretasks.py'])
+    module = types.ModuleType('coretasks_' + rev)
+    exec compile(source, 'coretasks.py@' + rev, 'exec') in module.__dict__
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--pace', type=float, default=2.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', metavar='REV')
+    parser.add_argument('--old-ls', action='store_true')
+    args = parser.parse_args()
+
+    runs = [('current', coretasks, ('CAP', 'LS', '302'))]
+    if args.compare:
+        ls = ('CAP', 'LS') if args.old_ls else ('CAP', 'LS', '302')
+        runs.append((args.compare, load_revision(args.compare), ls))
+
+    for label, module, ls in runs:
+        handlers = {'CAP': module.recieve_cap_list,
+                    'AUTHENTICATE': module.auth_proceed,
+                    '903': module.sasl_success}
+        times = []
+        for _ in xrange(args.repeat):
+            elapsed, stats = negotiate(handlers, ls, args.latency, args.pace)
+            times.append(elapsed)
+        print '%-10s connect to 001 %6.0fms   %d lines sent, %d CAP REQ' % (
+            label, min(times) * 1000, stats['lines'], stats['reqs'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+bench_dispatch.py - Time how long the bot takes over each line it receives
+Licensed under the Eiffel Forum License 2.
+
+Feeds the same PRIVMSG, with and without IRCv3 tags, through
+``found_terminator`` and ``dispatch`` many times, and reports the best mean
+time per line. The bot has ``--rules`` command rules, none of which match, as
+for the ordinary channel chatter that makes up most of a bot's input.
+
+It also reports how many objects each line allocates and still holds once
+``dispatch`` has tried every rule. Python 2 cannot count every allocation, so
+this counts the objects the garbage collector tracks, which are all of them
+but strings and numbers, over ``--alloc-number`` lines. The frames on the
+stack are among them, and are the same for every line.
+
+    python bench/bench_dispatch.py --rules 100
+
+``--compare REV`` also times the ``irc.py`` and ``bot.py`` of git revision
+``REV``. The rest of the package is used as it is now.
+"""
+
+import argparse
+import gc
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import sopel.bot
+import sopel.irc
+from sopel.config import Config
+
+LINES = [
+    ('tagged', '@time=2020-01-01T00:00:00.000Z;account=alice '
+     ':alice!~al@user/alice PRIVMSG #channel :just chatting, nothing for '
+     'the bot here'),
+    ('untagged', ':alice!~al@user/alice PRIVMSG #channel :just chatting, '
+     'nothing for the bot here'),
+]
+
+
+def make_bot(bot_module, irc_module, config, rules):
+    """
+    Return a ``Sopel`` from ``bot_module`` which is set up just enough to
+    take lines, without loading any modules or connecting.
+    """
+    class BenchBot(bot_module.Sopel):
+        def __init__(self):
+            irc_module.Bot.__init__(self, config.core)
+            self.config = config
+            self.commands = {'high': {}, 'medium': {}, 'low': {}}
+            for i in xrange(rules):
+                pattern = re.compile(r'\.cmd%d\b' % i)
+                self.commands['medium'][pattern] = []
+
+        def write(self, *args):
+            pass
+    return BenchBot()
+
+
+class Probe(object):
+    """
+    Stands in for the pattern of a rule which is tried after all the others,
+    and counts the objects the garbage collector tracks when it is.
+    """
+
+    def __init__(self):
+        self.count = None
+
+    def match(self, text):
+        self.count = len(gc.get_objects())
+        return None
+
+
+def allocations(bot, line, number):
+    """Return the mean number of objects ``bot`` holds on to per line."""
+    probe = Probe()
+    # The only low priority rule, so it is tried last.
+    bot.commands['low'][probe] = []
+    gc.collect()
+    gc.disable()
+    try:
+        total = 0
+        for _ in xrange(number):
+            before = len(gc.get_objects())
+            bot.buffer = line
+            bot.found_terminator()
+            total += probe.count - before
+    finally:
+        gc.enable()
+        del bot.commands['low'][probe]
+    return float(total) / number
+
+
+def load_revision(rev):
+    """Return the ``bot`` and ``irc`` modules as of git revision ``rev``."""
+    names = ('sopel.irc', 'sopel.bot')
+    saved = [sys.modules.get(name) for name in names]
+    modules = []
+    try:
+        for name in names:
+            path = name.replace('.', '/') + '.py'
+            source = subprocess.check_output(['git', '-C', ROOT, 'show',
+                                              '%s:%s' % (rev, path)])
+            # Named and registered inside the package, so that its imports
+            # find the rest of it, and the old bot.py finds the old irc.py.
+            module = types.ModuleType(name)
+            module.__file__ = os.path.join(ROOT, path)
+            sys.modules[name] = module
+            code = compile(source, '%s@%s' % (path, rev), 'exec')
+            exec code in module.__dict__
+            modules.append(module)
+    finally:
+        for name, module in zip(names, saved):
+            sys.modules[name] = module
+    irc_module, bot_module = modules
+    return bot_module, irc_module
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rules', type=int, default=100)
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--alloc-number', type=int, default=200)
+    parser.add_argument('--compare', metavar='REV')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.cfg')
+        with open(path, 'w') as cfg:
+            cfg.write('[core]\nnick = Sopel\nowner = Owner\n'
+                      'host = localhost\n')
+        config = Config(path)
+        # The file would give the string 'False', which is true.
+        config.core.log_raw = False
+
+        runs = [('current', sopel.bot, sopel.irc)]
+        if args.compare:
+            runs.append((args.compare,) + load_revision(args.compare))
+        for label, bot_module, irc_module in runs:
+            bot = make_bot(bot_module, irc_module, config, args.rules)
+            for kind, line in LINES:
+                def feed():
+                    bot.buffer = line
+                    bot.found_terminator()
+                best = min(timeit.repeat(feed, number=args.number,
+                                         repeat=args.repeat))
+                objects = allocations(bot, line, args.alloc_number)
+                print '%-10s %-8s %6.2fus %5.1f objects per line' % (
+                    label, kind, best / args.number * 1e6, objects)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
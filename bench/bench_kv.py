@@ -0,0 +1,75 @@
+# coding=utf-8
+"""
+bench_kv.py - Compare the kv settings database to sqlite
+Licensed under the Eiffel Forum License 2.
+
+Times ``Table.update`` and ``Table.get`` on the same ``--rows`` keys, once on a
+sqlite SopelDB and once on a kv one, then ``KVStore.get`` on its own. Each
+figure is the mean time of one call. Run it from the repository root:
+
+    python bench/bench_kv.py --rows 20000
+
+The databases go in a temporary directory unless ``--dir`` is given.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sopel.config import Config
+from sopel.db import SopelDB
+
+
+def open_db(directory, db_section):
+    path = os.path.join(directory, 'bench.cfg')
+    with open(path, 'w') as cfg:
+        cfg.write('[core]\nnick = Sopel\nowner = Owner\nhost = localhost\n'
+                  '[db]\n' + db_section)
+    return SopelDB(Config(path))
+
+
+def per_call(func, items):
+    started = time.time()
+    for item in items:
+        func(item)
+    return (time.time() - started) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--dir')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        backends = [
+            ('sqlite', 'userdb_type = sqlite\nuserdb_file = %s\n'
+             % os.path.join(directory, 'bench.db')),
+            ('kv', 'userdb_type = kv\nuserdb_dir = %s\n'
+             % os.path.join(directory, 'kv')),
+        ]
+        names = [u'nick%d' % i for i in xrange(args.rows)]
+        for label, section in backends:
+            db = open_db(directory, section)
+            db.add_table('prefs', ['name', 'tz'], 'name')
+            table = db.prefs
+            update = per_call(lambda name: table.update(name, {'tz': u'UTC'}),
+                              names)
+            get = per_call(lambda name: table.get(name, 'tz'), names)
+            print '%-7s update %7.1fus   get %6.1fus' % (label, update, get)
+
+        store = table._store
+        print 'KVStore.get %.2fus' % per_call(store.get, names)
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
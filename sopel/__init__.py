@@ -31,10 +31,14 @@ def run(config):
     def signal_handler(sig, frame):
         if sig == signal.SIGUSR1 or sig == signal.SIGTERM:
             stderr('Got quit signal, shutting down.')
-            p.quit('Closing')
+            if p is not None:
+                p.quit('Closing')
+    p = None
+    rejoin_channels = []
     while True:
         try:
             p = bot.Sopel(config)
+            p.rejoin_channels = rejoin_channels
             if hasattr(signal, 'SIGUSR1'):
                 signal.signal(signal.SIGUSR1, signal_handler)
             if hasattr(signal, 'SIGTERM'):
@@ -60,6 +64,12 @@ def run(config):
             break
         if p.hasquit or config.exit_on_error:
             break
+        # Get back into everything we were in, not just the configured ones.
+        rejoin_channels = list(p.channels)
+        # The old bot's scheduler thread keeps it alive, so make sure its
+        # database is closed, or the new bot could not open a kv one.
+        p.db.close()
+        p = None
         stderr('Warning: Disconnected. Reconnecting in %s seconds...' % delay)
         time.sleep(delay)
     os.unlink(config.pid_file_path)
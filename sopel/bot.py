@@ -19,9 +19,10 @@ from datetime import datetime
 from sopel import tools
 import irc
 from db import SopelDB
-from tools import (stderr, Nick, PriorityQueue, released,
+from tools import (stderr, PriorityQueue, released,
                    get_command_regexp)
 import module
+from membership import HALFPLUS, VOICES
 
 
 class Sopel(irc.Bot):
@@ -60,12 +61,17 @@ class Sopel(irc.Bot):
         Maps the capability name to a tuple of the prefix ('-', '=', or ''),
         the name of the requesting module, and the function to call if the
         request is rejected."""
+        self._cap_ls_done = False
+        """Whether the whole reply to the first CAP LS has been seen."""
+        self._cap_pending = set()
+        """The capabilities requested, but not yet accepted or refused."""
 
-        self.privileges = dict()
+        self.privileges = self.memberships.privileges
         """A dictionary of channels to their users and privilege levels
         The value associated with each channel is a dictionary of Nicks to a
         bitwise integer value, determined by combining the appropriate constants
-        from `module`."""
+        from `module`. This is the dictionary kept by ``memberships``, which
+        should be used to change it."""
 
         self.db = SopelDB(config)
         if self.db.check_table('locales', ['name'], 'name'):
@@ -126,10 +132,24 @@ class Sopel(irc.Bot):
             self._mutex = threading.Lock()
             # self.cleared is used for more fine grained locking.
             self._cleared = False
+            # Set when a job is added, so the wait for the next job can be
+            # cut short if the new one is due sooner.
+            self._wakeup = threading.Event()
 
         def add_job(self, job):
             """Add a Job to the current job queue."""
             self._jobs.put(job)
+            self._wakeup.set()
+
+        def call_later(self, delay, func):
+            """Call ``func(bot)`` once, ``delay`` seconds from now.
+
+            Like other jobs, ``func`` is run in its own thread unless its
+            ``thread`` attribute is False. No thread is kept waiting in the
+            meantime. Returns the Job."""
+            job = Sopel.Job(delay, func, once=True)
+            self.add_job(job)
+            return job
 
         def clear_jobs(self):
             """Clear current Job queue and start fresh."""
@@ -168,12 +188,13 @@ class Sopel(irc.Bot):
                     if duration <= 0:
                         break
                     with released(self._mutex):
-                        time.sleep(duration)
+                        self._wakeup.wait(duration)
+                        self._wakeup.clear()
 
                 self._cleared = False
                 job = self._jobs.get()
                 with released(self._mutex):
-                    if job.func.thread:
+                    if getattr(job.func, 'thread', True):
                         t = threading.Thread(
                             target=self._call, args=(job.func,)
                         )
@@ -183,7 +204,7 @@ class Sopel(irc.Bot):
                     job.next()
                 # If jobs were cleared during the call, don't put an old job
                 # into the new job queue.
-                if not self._cleared:
+                if not self._cleared and not job.once:
                     self._jobs.put(job)
 
         def _call(self, func):
@@ -213,15 +234,17 @@ class Sopel(irc.Bot):
         calling the same function too many times at once.
         """
 
-        def __init__(self, interval, func):
+        def __init__(self, interval, func, once=False):
             """Initialize Job.
             Args:
                 interval: number of seconds between calls to func
                 func: function to be called
+                once: if True, func is called only once, after interval
             """
             self.next_time = time.time() + interval
             self.interval = interval
             self.func = func
+            self.once = once
 
         def next(self):
             """Update self.next_time with the assumption func was just called.
@@ -250,7 +273,7 @@ class Sopel(irc.Bot):
 
         def __cmp__(self, other):
             """Compare Job objects according to attribute next_time."""
-            return self.next_time - other.next_time
+            return cmp(self.next_time, other.next_time)
 
         def __str__(self):
             """Return a string representation of the Job object.
@@ -265,6 +288,14 @@ class Sopel(irc.Bot):
             """This is an iterator. Never stops though."""
             return self
 
+    def handle_connect(self):
+        # Everything that isn't threaded is called from the I/O loop, which
+        # runs on this thread. Queries made here before connecting, such as
+        # those of the modules' setup functions, held up nothing, so only
+        # those made from now on are counted.
+        self.db.io_thread = threading.current_thread()
+        irc.Bot.handle_connect(self)
+
     def setup(self):
         stderr(u"\nWelcome to MasterBot launcher. Loading modules...\n\n")
         self.callables = set()
@@ -516,122 +547,233 @@ class Sopel(irc.Bot):
         def __getattr__(self, attr):
             return getattr(self.bot, attr)
 
+    class TriggerContext(object):
+        """
+        What every ``Trigger`` made from one line has in common. Whether the
+        sender is an admin or the owner, and their privileges in the channel,
+        are worked out the first time a trigger asks, and shared by the rest.
+        """
+
+        __slots__ = ('bot', 'origin', 'event', 'args', '_admin', '_owner',
+                     '_privileges')
+
+        def __init__(self, bot, origin, event, args):
+            self.bot = bot
+            self.origin = origin
+            self.event = event
+            self.args = args
+            self._admin = None
+            self._owner = None
+            self._privileges = None
+
+        @property
+        def admin(self):
+            if self._admin is None:
+                self._auth()
+            return self._admin
+
+        @property
+        def owner(self):
+            if self._owner is None:
+                self._auth()
+            return self._owner
+
+        def _auth(self):
+            config = self.bot.config
+            origin = self.origin
+            admins = config.core.get_list('admins')
+            if len(admins) > 0:
+                admin = any(origin.nick == n for n in admins)
+            else:
+                admin = False
+
+            # Support specifying admins by hostnames
+            if not admin and len(admins) > 0:
+                for each_admin in admins:
+                    re_admin = re.compile(each_admin)
+                    if re_admin.findall(origin.host):
+                        admin = True
+                    elif '@' in each_admin:
+                        temp = each_admin.split('@')
+                        re_host = re.compile(temp[1])
+                        if re_host.findall(origin.host):
+                            admin = True
+
+            if not config.core.owner:
+                owner = False
+            elif '@' in config.core.owner:
+                owner = origin.nick + '@' + origin.host == config.core.owner
+            else:
+                owner = (origin.nick == config.core.owner)
+
+            # Bot owner inherits all the admin rights, therefore is considered
+            # admin
+            self._admin = admin or owner
+            self._owner = owner
+
+        @property
+        def privileges(self):
+            """The sender's privileges in the channel, or 0 in a PM."""
+            if self._privileges is None:
+                origin = self.origin
+                if origin.sender is not origin.nick:  # no ops in PM
+                    users = self.bot.privileges.get(origin.sender, {})
+                    self._privileges = users.get(origin.nick, 0)
+                else:
+                    self._privileges = 0
+            return self._privileges
+
     class Trigger(unicode):
-        def __new__(cls, text, origin, bytes, match, event, args, self):
+        """
+        The text of a line which matched a rule, with everything known about
+        where it came from. Triggers made from the same line share one
+        ``TriggerContext``, and most of their attributes are only worked out
+        when they are read.
+        """
+
+        __slots__ = ('_context', 'bytes', 'match')
+
+        def __new__(cls, text, origin, bytes, match, event, args, self,
+                    context=None):
             s = unicode.__new__(cls, text)
-            s.sender = origin.sender
+            if context is None:
+                context = Sopel.TriggerContext(self, origin, event, args)
+            s._context = context
+            s.bytes = bytes
+            """
+            The text which triggered the message. Equivalent to
+            ``Trigger.group(0)``.
+            """
+            s.match = match
+            """
+            The regular expression ``MatchObject_`` for the triggering line.
+            .. _MatchObject: http://docs.python.org/library/re.html#match-objects
+            """
+            return s
 
+        @property
+        def sender(self):
             """
             The channel (or nick, in a private message) from which the
             message was sent.
             """
-            s.hostmask = origin.hostmask
+            return self._context.origin.sender
+
+        @property
+        def hostmask(self):
             """
             Hostmask of the person who sent the message in the form
             <nick>!<user>@<host>
             """
-            s.user = origin.user
+            return self._context.origin.hostmask
+
+        @property
+        def user(self):
             """Local username of the person who sent the message"""
-            s.nick = origin.nick
+            return self._context.origin.user
+
+        @property
+        def nick(self):
             """The ``Nick`` of the person who sent the message."""
-            s.event = event
+            return self._context.origin.nick
+
+        @property
+        def host(self):
+            """Host of the person who sent the message"""
+            return self._context.origin.host
+
+        @property
+        def event(self):
             """
             The IRC event (e.g. ``PRIVMSG`` or ``MODE``) which triggered the
             message."""
-            s.bytes = bytes
-            """
-            The text which triggered the message. Equivalent to
-            ``Trigger.group(0)``.
-            """
-            s.match = match
-            """
-            The regular expression ``MatchObject_`` for the triggering line.
-            .. _MatchObject: http://docs.python.org/library/re.html#match-objects
-            """
-            s.group = match.group
+            return self._context.event
+
+        @property
+        def group(self):
             """The ``group`` function of the ``match`` attribute.
             See Python ``re_`` documentation for details."""
-            s.groups = match.groups
+            return self.match.group
+
+        @property
+        def groups(self):
             """The ``groups`` function of the ``match`` attribute.
             See Python ``re_`` documentation for details."""
-            s.args = args
+            return self.match.groups
+
+        @property
+        def args(self):
             """
             A tuple containing each of the arguments to an event. These are the
             strings passed between the event name and the colon. For example,
             setting ``mode -m`` on the channel ``#example``, args would be
             ``('#example', '-m')``
             """
-            s.tags = origin.tags
-            """A map of the IRCv3 message tags on the message.
-            If the message had no tags, or the server does not support IRCv3
-            message tags, this will be an empty dict."""
-            if len(self.config.core.get_list('admins')) > 0:
-                s.admin = (origin.nick in
-                           [Nick(n) for n in
-                            self.config.core.get_list('admins')])
-            else:
-                s.admin = False
-
+            return self._context.args
+
+        @property
+        def tags(self):
+            """A read-only map of the IRCv3 message tags on the message, with
+            their values unescaped, as a ``MessageTags``. If the message had no
+            tags, or the server does not support IRCv3 message tags, this will
+            be empty."""
+            return self._context.origin.tags
+
+        @property
+        def admin(self):
             """
             True if the nick which triggered the command is in Sopel's admin
             list as defined in the config file.
             """
+            return self._context.admin
 
-            # Support specifying admins by hostnames
-            if not s.admin and len(self.config.core.get_list('admins')) > 0:
-                for each_admin in self.config.core.get_list('admins'):
-                    re_admin = re.compile(each_admin)
-                    if re_admin.findall(origin.host):
-                        s.admin = True
-                    elif '@' in each_admin:
-                        temp = each_admin.split('@')
-                        re_host = re.compile(temp[1])
-                        if re_host.findall(origin.host):
-                            s.admin = True
+        @property
+        def owner(self):
+            """True if the nick which triggered the command is Sopel's owner."""
+            return self._context.owner
 
-            if not self.config.core.owner:
-                s.owner = False
-            elif '@' in self.config.core.owner:
-                s.owner = origin.nick + '@' + \
-                    origin.host == self.config.core.owner
-            else:
-                s.owner = (origin.nick == Nick(self.config.core.owner))
+        @property
+        def ops(self):
+            """
+            List of channel operators in the channel the message was
+            recived in
+            """
+            context = self._context
+            if context.origin.sender is context.origin.nick:
+                return []
+            return context.bot.ops.get(context.origin.sender, [])
 
-            # Bot owner inherits all the admin rights, therefore is considered
-            # admin
-            s.admin = s.admin or s.owner
-
-            s.host = origin.host
-            if s.sender is not s.nick:  # no ops in PM
-                s.ops = self.ops.get(s.sender, [])
-                """
-                List of channel operators in the channel the message was
-                recived in
-                """
-                s.halfplus = self.halfplus.get(s.sender, [])
-                """
-                List of channel half-operators in the channel the message was
-                recived in
-                """
-                s.isop = (s.nick in s.ops or
-                          s.nick in s.halfplus)
-                """True if the user is half-op or an op"""
-                s.voices = self.voices.get(s.sender, [])
-                """
-                List of channel operators in the channel the message was
-                recived in
-                """
-                s.isvoice = (s.nick in s.ops or
-                             s.nick in s.halfplus or
-                             s.nick in s.voices)
-                """True if the user is voiced, has op, or has half-op"""
-            else:
-                s.isop = False
-                s.isvoice = False
-                s.ops = []
-                s.halfplus = []
-                s.voices = []
-            return s
+        @property
+        def halfplus(self):
+            """
+            List of channel half-operators in the channel the message was
+            recived in
+            """
+            context = self._context
+            if context.origin.sender is context.origin.nick:
+                return []
+            return context.bot.halfplus.get(context.origin.sender, [])
+
+        @property
+        def voices(self):
+            """
+            List of channel operators in the channel the message was
+            recived in
+            """
+            context = self._context
+            if context.origin.sender is context.origin.nick:
+                return []
+            return context.bot.voices.get(context.origin.sender, [])
+
+        @property
+        def isop(self):
+            """True if the user is half-op or an op"""
+            return bool(self._context.privileges & HALFPLUS)
+
+        @property
+        def isvoice(self):
+            """True if the user is voiced, has op, or has half-op"""
+            return bool(self._context.privileges & VOICES)
 
     def call(self, func, origin, sopel, trigger):
         nick = trigger.nick
@@ -674,7 +816,9 @@ class Sopel(irc.Bot):
     def dispatch(self, origin, text, args):
         event, args = args[0], args[1:]
 
-        wrapper = self.SopelWrapper(self, origin)
+        # Only made once a rule matches, or a handler is actually called.
+        context = None
+        wrapper = None
 
         if self.config.core.nick_blocks or self.config.core.host_blocks:
             nick_blocked = self._nick_blocked(origin.nick)
@@ -690,14 +834,16 @@ class Sopel(irc.Bot):
                 match = regexp.match(text)
                 if not match:
                     continue
-                trigger = self.Trigger(
-                    text, origin, text, match, event, args, self
-                )
+                if context is None:
+                    context = self.TriggerContext(self, origin, event, args)
+                # Many rules, such as coretasks' .* ones, match every line but
+                # only handle one event, so the trigger is made when needed.
+                trigger = None
 
                 for func in funcs:
-                    if (not trigger.admin and
-                            not func.unblockable and
-                            (nick_blocked or host_blocked)):
+                    if (not func.unblockable and
+                            (nick_blocked or host_blocked) and
+                            not context.admin):
                         function_name = "%s.%s" % (
                             func.__module__, func.__name__
                         )
@@ -708,6 +854,11 @@ class Sopel(irc.Bot):
                         continue
                     if self.limit(origin, func):
                         continue
+                    if trigger is None:
+                        trigger = self.Trigger(text, origin, text, match,
+                                               event, args, self, context)
+                    if wrapper is None:
+                        wrapper = self.SopelWrapper(self, origin)
                     if func.thread:
                         targs = (func, origin, wrapper, trigger)
                         t = threading.Thread(target=self.call, args=targs)
@@ -750,7 +901,7 @@ class Sopel(irc.Bot):
             if not bad_nick:
                 continue
             if (re.match(bad_nick + '$', nick, re.IGNORECASE) or
-                    Nick(bad_nick) == nick):
+                    nick == bad_nick):
                 return True
         return False
 
@@ -811,6 +962,7 @@ class Sopel(irc.Bot):
                         shutdown_method.__module__, e
                     )
                 )
+        self.db.close()
 
     def cap_req(self, module_name, capability, failure_callback):
         """Tell Sopel to request a capability when it starts.
@@ -14,7 +14,6 @@ responses to standard IRC codes without having to shove them all into the
 dispatch function in bot.py and making it easier to maintain.
 """
 import re
-import time
 import sopel
 from sopel.tools import Nick
 import base64
@@ -44,7 +43,8 @@ def startup(bot, trigger):
     """Do tasks related to connecting to the network.
 
     001 RPL_WELCOME is from RFC2812 and is the first message that is sent
-    after the connection has been registered on the network.
+    after the connection has been registered on the network. Channels are
+    joined later, by ``join_channels``.
     """
     bot.connection_registered = True
 
@@ -69,17 +69,46 @@ def startup(bot, trigger):
     bot.write(('MODE ', '%s +%s' % (bot.nick, modes)))
 
     bot.memory['retry_join'] = dict()
-    for channel in bot.config.core.get_list('channels'):
-        bot.join(channel)
+    bot.memory['startup_join'] = True
+
+
+@sopel.module.event('376')
+@sopel.module.rule('.*')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def join_channels(bot, trigger):
+    """Join the configured channels once registration is complete.
+
+    376 RPL_ENDOFMOTD comes after the 005 RPL_ISUPPORT lines, so by then the
+    JOINs can be batched to the server's TARGMAX and line length. Later MOTDs,
+    such as one requested with the MOTD command, join nothing.
+    """
+    if bot.memory.pop('startup_join', False):
+        bot.join_many(bot.config.core.get_list('channels') +
+                      bot.rejoin_channels)
+
+
+@sopel.module.event('422')
+@sopel.module.rule('.*')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def nomotd_join_channels(bot, trigger):
+    """Join the configured channels on servers with no MOTD.
+
+    422 ERR_NOMOTD is sent in place of the MOTD and its 376 RPL_ENDOFMOTD.
+    """
+    join_channels(bot, trigger)
 
 
 @sopel.module.event('477')
 @sopel.module.rule('.*')
+@sopel.module.thread(False)
 @sopel.module.priority('high')
 def retry_join(bot, trigger):
     """
     Give NickServ enough time to identify, and retry rejoining an
-    identified-only (+R) channel. Maximum of ten rejoin attempts.
+    identified-only (+R) channel. Maximum of ten rejoin attempts, waiting
+    twice as long before each one, from 5 seconds up to 5 minutes.
     """
     channel = trigger.args[1]
     if channel in bot.memory['retry_join'].keys():
@@ -92,133 +121,120 @@ def retry_join(bot, trigger):
         bot.join(channel)
         return
 
-    time.sleep(6)
-    bot.join(channel)
+    attempt = bot.memory['retry_join'][channel]
+    delay = min(5 * 2 ** (attempt - 1), 300)
+
+    def rejoin(bot):
+        bot.join(channel)
+    rejoin.thread = False
+    bot.scheduler.call_later(delay, rejoin)
 
 #Functions to maintain a list of chanops in all of sopel's channels.
 
 
+@sopel.module.rule('.*')
+@sopel.module.event('005')
+@sopel.module.thread(False)
+@sopel.module.priority('high')
+@sopel.module.unblockable
+def handle_isupport(bot, trigger):
+    """Record the features the server supports, from RPL_ISUPPORT."""
+    # args are our nick, the tokens, and "are supported by this server".
+    bot.isupport.parse(trigger.args[1:-1])
+    bot.memberships.set_casemapping(bot.isupport.lower)
+
+
+def parse_names(names, prefixes, intern=Nick):
+    """
+    Parse the space-separated ``names`` of a NAMES reply. Return a dict of
+    each ``Nick`` to its privileges, given by the ``prefixes`` before it,
+    which map each prefix to the privileges it means (see
+    ``ISupport.prefixes``), and a dict of each ``Nick`` sent as
+    ``nick!user@host``, as with ``userhost-in-names``, to its ``(user,
+    host)``. Each ``Nick`` is made by ``intern``, such as
+    ``MembershipStore.intern``.
+    """
+    roster = {}
+    hosts = {}
+    for name in names.split():
+        priv = 0
+        i = 0
+        end = len(name) - 1
+        while i < end and name[i] in prefixes:
+            priv |= prefixes[name[i]]
+            i += 1
+        nick, _, userhost = name[i:].partition('!')
+        nick = intern(nick)
+        roster[nick] = priv
+        if userhost:
+            user, _, host = userhost.partition('@')
+            hosts[nick] = (user, host)
+    return roster, hosts
+
+
 @sopel.module.rule('(.*)')
 @sopel.module.event('353')
 @sopel.module.thread(False)
 @sopel.module.unblockable
 def handle_names(bot, trigger):
     ''' Handle NAMES response, happens when joining to channels'''
-    names = re.split(' ', trigger)
-    channels = re.search('(#\S*)', bot.raw)
-    if (channels is None):
+    # args are our nick, the channel type, the channel and the names. The
+    # roster is collected over every 353 line, and applied by end_names.
+    if len(trigger.args) < 4:
         return
-    channel = channels.group(1)
-    if channel not in bot.privileges:
-        bot.privileges[channel] = dict()
-    bot.init_ops_list(channel)
-    for name in names:
-        priv = 0
-        # This could probably be made flexible in the future, but I don't think
-        # it'd be worht it.
-        mapping = {'+': sopel.module.VOICE,
-                   '%': sopel.module.HALFOP,
-                   '@': sopel.module.OP,
-                   '&': sopel.module.ADMIN,
-                   '~': sopel.module.OWNER}
-        for prefix, value in mapping.iteritems():
-            if prefix in name:
-                priv = priv | value
-        nick = Nick(name.lstrip(''.join(mapping.keys())))
-        bot.privileges[channel][nick] = priv
-
-        # Old op list maintenance is down here, and should be removed at some
-        # point
-        if '@' in name or '~' in name or '&' in name:
-            bot.add_op(channel, name.lstrip('@&%+~'))
-            bot.add_halfop(channel, name.lstrip('@&%+~'))
-            bot.add_voice(channel, name.lstrip('@&%+~'))
-        elif '%' in name:
-            bot.add_halfop(channel, name.lstrip('@&%+~'))
-            bot.add_voice(channel, name.lstrip('@&%+~'))
-        elif '+' in name:
-            bot.add_voice(channel, name.lstrip('@&%+~'))
+    roster, hosts = parse_names(trigger.args[3], bot.isupport.prefixes,
+                                bot.memberships.intern)
+    bot.memberships.add_names(trigger.args[2], roster, hosts)
+
+
+@sopel.module.rule('.*')
+@sopel.module.event('366')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def end_names(bot, trigger):
+    """Replace the users of a channel with those the NAMES reply listed."""
+    if len(trigger.args) < 2:
+        return
+    bot.memberships.end_names(trigger.args[1])
 
 
 @sopel.module.rule('(.*)')
 @sopel.module.event('MODE')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_modes(bot, trigger):
     ''' Track usermode changes and keep our lists of ops up to date '''
     line = trigger.args
 
-    # If the first character of where the mode is being set isn't a #
-    # then it's a user mode, not a channel mode, so we'll ignore it.
-    if line[0][0] != '#':
+    # If where the mode is being set isn't a channel, then it's a user mode,
+    # not a channel mode, so we'll ignore it.
+    if len(line) < 2 or line[0][:1] not in bot.isupport.chantypes:
         return
-    channel, mode_sec = line[:2]
-    nicks = [Nick(n) for n in line[2:]]
-
-    # Break out the modes, because IRC allows e.g. MODE +aB-c foo bar baz
-    sign = ''
-    modes = []
-    for char in mode_sec:
-        if char == '+' or char == '-':
-            sign = char
+    channel = line[0]
+
+    # Modes are paired with their arguments according to the server's
+    # PREFIX and CHANMODES, since only some of them take one. IRC allows
+    # e.g. MODE +ob-l foo bar!*@*
+    for sign, mode, nick in bot.isupport.parse_modes(line[1], line[2:]):
+        value = bot.isupport.prefix_modes.get(mode)
+        if not value:
+            continue
+        if nick is None:
+            bot.debug(
+                __file__,
+                'MODE recieved from server with more modes than arguments.',
+                'warning'
+            )
+            return
+        if sign == '+':
+            bot.memberships.add_privileges(channel, nick, value)
         else:
-            modes.append(sign + char)
-
-    # Some basic checks for broken replies from server. Probably unnecessary.
-    if len(modes) > len(nicks):
-        bot.debug(
-            __file__,
-            'MODE recieved from server with more modes than nicks.',
-            'warning'
-        )
-        modes = modes[:(len(nicks) + 1)]  # Try truncating, in case that works.
-    elif len(modes) < len(nicks):
-        bot.debug(
-            __file__,
-            'MODE recieved from server with more nicks than modes.',
-            'warning'
-        )
-        nicks = nicks[:(len(modes) - 1)]  # Try truncating, in case that works.
-    # This one is almost certainly unneeded.
-    if not (len(modes) and len(nicks)):
-        bot.debug(
-            __file__,
-            'MODE recieved from server without arguments',
-            'verbose'
-        )
-        return  # Nothing to do here.
-
-    mapping = {'v': sopel.module.VOICE,
-               'h': sopel.module.HALFOP,
-               'o': sopel.module.OP,
-               'a': sopel.module.ADMIN,
-               'q': sopel.module.OWNER}
-    for nick, mode in zip(nicks, modes):
-        priv = bot.privileges[channel].get(nick) or 0
-        value = mapping.get(mode[1])
-        if value is not None:
-            priv = priv | value
-            bot.privileges[channel][nick] = priv
-
-        #Old mode maintenance
-        if mode[1] == 'o' or mode[1] == 'q' or mode[1] == 'a':
-            if mode[0] == '+':
-                bot.add_op(channel, nick)
-            else:
-                bot.del_op(channel, nick)
-        elif mode[1] == 'h':  # Halfop
-            if mode[0] == '+':
-                bot.add_halfop(channel, nick)
-            else:
-                bot.del_halfop(channel, nick)
-        elif mode[1] == 'v':
-            if mode[0] == '+':
-                bot.add_voice(channel, nick)
-            else:
-                bot.del_voice(channel, nick)
+            bot.memberships.remove_privileges(channel, nick, value)
 
 
 @sopel.module.rule('.*')
 @sopel.module.event('NICK')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_nicks(bot, trigger):
     '''Track nickname changes and maintain our chanops list accordingly'''
@@ -242,80 +258,109 @@ def track_nicks(bot, trigger):
         bot.msg(bot.config.core.owner, privmsg)
         return
 
-    for channel in bot.privileges:
-        if old in bot.privileges[channel]:
-            value = bot.privileges[channel].pop(old)
-            bot.privileges[channel][new] = value
-
-    # Old privilege maintenance
-    for channel in bot.halfplus:
-        if old in bot.halfplus[channel]:
-            bot.del_halfop(channel, old)
-            bot.add_halfop(channel, new)
-    for channel in bot.ops:
-        if old in bot.ops[channel]:
-            bot.del_op(channel, old)
-            bot.add_op(channel, new)
-    for channel in bot.voices:
-        if old in bot.voices[channel]:
-            bot.del_voice(channel, old)
-            bot.add_voice(channel, new)
+    bot.memberships.rename(old, new)
 
 
 @sopel.module.rule('(.*)')
 @sopel.module.event('PART')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_part(bot, trigger):
     try:
         if trigger.nick == bot.nick:
             bot.channels.remove(trigger.sender)
-            del bot.privileges[trigger.sender]
+            bot.memberships.remove_channel(trigger.sender)
         else:
-            del bot.privileges[trigger.sender][trigger.nick]
+            bot.memberships.part(trigger.sender, trigger.nick)
     except:
         pass
 
 
 @sopel.module.rule('.*')
 @sopel.module.event('KICK')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_kick(bot, trigger):
     try:
-        nick = Nick(trigger.args[1])
+        nick = bot.memberships.intern(trigger.args[1])
         if nick == bot.nick:
             bot.channels.remove(trigger.sender)
-            del bot.privileges[trigger.sender]
+            bot.memberships.remove_channel(trigger.sender)
         else:
-            del bot.privileges[trigger.sender][nick]
+            bot.memberships.part(trigger.sender, nick)
     except:
         pass
 
 
 @sopel.module.rule('.*')
 @sopel.module.event('JOIN')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_join(bot, trigger):
     try:
         if trigger.nick == bot.nick and trigger.sender not in bot.channels:
             bot.channels.append(trigger.sender)
-            bot.privileges[trigger.sender] = dict()
-        bot.privileges[trigger.sender][trigger.nick] = 0
+            bot.memberships.remove_channel(trigger.sender)
+            bot.memberships.add_channel(trigger.sender)
+        # With extended-join, args are the channel, the account (or * if
+        # none) and the real name.
+        account = trigger.args[1] if len(trigger.args) > 2 else None
+        bot.memberships.join(trigger.sender, trigger.nick, trigger.user,
+                             trigger.host, account)
     except:
         pass
 
 
+@sopel.module.rule('.*')
+@sopel.module.event('ACCOUNT')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_account(bot, trigger):
+    """Record a user logging in to or out of services, from account-notify."""
+    if trigger.args:
+        bot.memberships.set_account(trigger.nick, trigger.args[0])
+
+
+@sopel.module.rule('.*')
+@sopel.module.event('AWAY')
+@sopel.module.thread(False)
+@sopel.module.unblockable
+def track_away(bot, trigger):
+    """Record a user going away or coming back, from away-notify."""
+    # AWAY with a message means they went away; without one, they're back.
+    message = trigger.args[0] if trigger.args else None
+    bot.memberships.set_away(trigger.nick, message)
+
+
+netsplit_reason = re.compile(r'^\S+\.\S+ \S+\.\S+$')
+
+
 @sopel.module.rule('.*')
 @sopel.module.event('QUIT')
+@sopel.module.thread(False)
 @sopel.module.unblockable
 def track_quit(bot, trigger):
     try:
-        for chanprivs in bot.privileges.values():
-            if trigger.nick in chanprivs:
-                del chanprivs[trigger.nick]
+        # A netsplit QUIT gives the names of the two servers which split,
+        # or "*.net *.split" on networks which hide them.
+        if netsplit_reason.match(trigger):
+            bot.memberships.split_quit(trigger.nick)
+        else:
+            bot.memberships.quit(trigger.nick)
     except:
         pass
 
 
+@sopel.module.interval(1)
+@sopel.module.thread(False)
+def flush_netsplits(bot):
+    """Apply netsplit QUITs and JOINs which have been buffered."""
+    count = bot.memberships.flush()
+    if count:
+        bot.debug(__file__, 'Applied %d netsplit QUITs and JOINs.' % count,
+                  'verbose')
+
+
 @sopel.module.rule('.*')
 @sopel.module.event('CAP')
 @sopel.module.thread(False)
@@ -325,55 +370,132 @@ def recieve_cap_list(bot, trigger):
     # Server is listing capabilites
     if trigger.args[1] == 'LS':
         recieve_cap_ls_reply(bot, trigger)
+    # Server accepted CAP REQ
+    elif trigger.args[1] == 'ACK':
+        recieve_cap_ack(bot, trigger)
     # Server denied CAP REQ
     elif trigger.args[1] == 'NAK':
-        entry = bot._cap_reqs.get(trigger, None)
-        # If it was requested with bot.cap_req
-        if entry:
-            for req in entry:
-                # And that request was mandatory/prohibit, and a callback was
-                # provided
-                if req[0] and req[2]:
-                    # Call it.
-                    req[2](bot, req[0] + trigger)
-    # Server is acknowledinge SASL for us.
-    elif (trigger.args[0] == bot.nick and trigger.args[1] == 'ACK' and
-          'sasl' in trigger.args[2]):
-        recieve_cap_ack_sasl(bot)
+        recieve_cap_nak(bot, trigger)
+
+
+core_capabilities = ('multi-prefix', 'extended-join', 'account-notify',
+                     'away-notify', 'userhost-in-names')
+"""The capabilities which coretasks requests, when the server offers them."""
 
 
 def recieve_cap_ls_reply(bot, trigger):
-    if bot.server_capabilities:
+    if bot._cap_ls_done:
         # We've already seen the results, so someone sent CAP LS from a module.
         # We're too late to do SASL, and we don't want to send CAP END before
         # the module has done what it needs to, so just return
         return
-    bot.server_capabilities = set(trigger.split(' '))
-
-    # If some other module requests it, we don't need to add another request.
-    # If some other module prohibits it, we shouldn't request it.
-    if 'multi-prefix' not in bot._cap_reqs:
-        # Whether or not the server supports multi-prefix doesn't change how we
-        # parse it, so we don't need to worry if it fails.
-        bot._cap_reqs['multi-prefix'] = ['', 'coretasks', None]
-
-    for cap, req in bot._cap_reqs.iteritems():
-        # It's not required, or it's supported, so we can request it
-        if req[0] != '=' or cap in bot.server_capabilities:
-            # REQs fail as a whole, so we send them one capability at a time
-            bot.write(('CAP', 'REQ', req[0] + cap))
-        elif req[2]:
-            # Server is going to fail on it, so we call the failure function
-            req[2](bot, req[0] + cap)
+    # With CAP LS 302, capabilities may have values, as in sasl=PLAIN. Only
+    # their names are needed to request them.
+    for cap in trigger.split():
+        bot.server_capabilities.add(cap.partition('=')[0])
+    if len(trigger.args) > 3 and trigger.args[2] == '*':
+        # A long list is split over several lines, with a * before the list
+        # on all but the last.
+        return
+    bot._cap_ls_done = True
+
+    # If some other module requests these, we don't need to add another
+    # request. If some other module prohibits them, we shouldn't request them.
+    # We parse what the server sends the same way whether or not they are
+    # enabled, so we don't need to worry if they fail.
+    for cap in core_capabilities:
+        if cap in bot.server_capabilities and cap not in bot._cap_reqs:
+            bot._cap_reqs[cap] = [('', 'coretasks', None)]
+
+    caps = []
+    for cap, entry in bot._cap_reqs.iteritems():
+        if any(req[0] == '=' for req in entry):
+            prefix = '='
+        else:
+            prefix = entry[0][0]
+        if cap in bot.server_capabilities:
+            caps.append('-' + cap if prefix == '-' else cap)
+        elif prefix == '=':
+            # Server is going to fail on it, so we call the failure functions
+            for req in entry:
+                if req[2]:
+                    req[2](bot, req[0] + cap)
 
     # If we want to do SASL, we have to wait before we can send CAP END. So if
     # we are, wait on 903 (SASL successful) to send it.
+    sasl = False
     if bot.config.core.sasl_password:
-        bot.write(('CAP', 'REQ', 'sasl'))
-    else:
+        if 'sasl' in bot.server_capabilities:
+            caps.append('sasl')
+            sasl = True
+        else:
+            bot.debug(__file__, 'Server does not support SASL.', 'always')
+    request_capabilities(bot, caps)
+    if not sasl:
+        # The server handles the REQs before the END, so there's no need to
+        # wait for the answer. Anything it refuses can still be requested
+        # afterwards.
         bot.write(('CAP', 'END'))
 
 
+def request_capabilities(bot, caps):
+    """
+    Request ``caps``, a list of capability names with an optional ``-``
+    prefix, in as few ``CAP REQ`` lines as fit.
+    """
+    bot._cap_pending.update(cap.lstrip('-') for cap in caps)
+    limit = bot.isupport.linelen - len('CAP REQ :\r\n')
+    line = []
+    length = -1
+    for cap in caps:
+        if line and length + 1 + len(cap) > limit:
+            bot.write(('CAP', 'REQ'), ' '.join(line))
+            line = []
+            length = -1
+        line.append(cap)
+        length += 1 + len(cap)
+    if line:
+        bot.write(('CAP', 'REQ'), ' '.join(line))
+
+
+def recieve_cap_ack(bot, trigger):
+    for cap in trigger.split():
+        if cap.startswith('-'):
+            cap = cap[1:]
+            bot.enabled_capabilities.discard(cap)
+        else:
+            # Older servers may mark capabilities with ~ or =.
+            cap = cap.lstrip('~=')
+            bot.enabled_capabilities.add(cap)
+        bot._cap_pending.discard(cap)
+        # Server is acknowledinge SASL for us.
+        if cap == 'sasl':
+            recieve_cap_ack_sasl(bot)
+
+
+def recieve_cap_nak(bot, trigger):
+    caps = trigger.split()
+    if len(caps) > 1:
+        # A REQ is refused as a whole, so ask for each capability on its own
+        # to find out which ones the server won't give us.
+        for cap in caps:
+            request_capabilities(bot, [cap])
+        return
+    for cap in caps:
+        cap = cap.lstrip('-')
+        bot._cap_pending.discard(cap)
+        if cap == 'sasl' and bot.config.core.sasl_password:
+            # We held off on CAP END for SASL, which we aren't getting now.
+            bot.write(('CAP', 'END'))
+        # If it was requested with bot.cap_req
+        for req in bot._cap_reqs.get(cap, ()):
+            # And that request was mandatory/prohibit, and a callback was
+            # provided
+            if req[0] and req[2]:
+                # Call it.
+                req[2](bot, req[0] + cap)
+
+
 def recieve_cap_ack_sasl(bot):
     # Presumably we're only here if we said we actually *want* sasl, but still
     # check anyway.
@@ -401,6 +523,73 @@ def sasl_success(bot, trigger):
     bot.write(('CAP', 'END'))
 
 
+@sopel.module.commands('dbstats')
+@sopel.module.priority('low')
+@sopel.module.unblockable
+def dbstats(bot, trigger):
+    """
+    Show how much each table of the settings database is queried, and how
+    long the queries take. Give a table name to show only that table, or
+    "reset" to start counting again.
+    """
+    if not trigger.admin:
+        return
+
+    metrics = bot.db.metrics
+    arg = trigger.group(2)
+    if arg:
+        arg = arg.strip()
+    if arg == 'reset':
+        metrics.reset()
+        bot.reply('Database metrics cleared.')
+        return
+
+    tables = dict(metrics.tables)
+    if arg:
+        if arg not in tables:
+            bot.reply('No queries recorded for table %s.' % arg)
+            return
+        names = [arg]
+    elif not tables:
+        bot.reply('No queries recorded.')
+        return
+    else:
+        names = sorted(tables)
+
+    labels = metrics.labels()
+    for name in names:
+        table = tables[name]
+        count = table['reads'] + table['writes']
+        histogram = ' '.join('%s:%d' % (label, n) for label, n
+                             in zip(labels, table['histogram']) if n)
+        bot.say('%s: %d reads, %d writes, %d rows, avg %.1fms [%s]' % (
+            name, table['reads'], table['writes'], table['rows'],
+            table['time'] * 1000 / max(count, 1), histogram))
+    if not arg and bot.db.io_thread_calls:
+        offenders = sorted(bot.db.io_thread_calls.items(),
+                           key=lambda item: -item[1])
+        bot.say('Queries from the I/O thread: ' + ', '.join(
+            '%s (%d)' % offender for offender in offenders))
+
+
+@sopel.module.interval(300)
+def expire_db_rows(bot):
+    """Delete rows which have outlived their table's TTL."""
+    purged = bot.db.expire()
+    for name, count in sorted(purged.items()):
+        bot.debug(__file__, 'Expired %d rows from %s.' % (count, name),
+                  'verbose')
+
+
+@sopel.module.interval(10)
+def sync_db(bot):
+    """Pick up changes other bots sharing the database have made to it."""
+    changed = bot.db.sync()
+    if changed:
+        bot.debug(__file__, 'Database changed: %s.' % ', '.join(changed),
+                  'verbose')
+
+
 #Live blocklist editing
 
 
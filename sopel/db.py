@@ -15,10 +15,31 @@ Licensed under the Eiffel Forum License 2.
 http://sopel.chat
 """
 
+import os
+import re
+import contextlib
+import sys
+import time
+import itertools
+import threading
+import Queue
 from collections import Iterable
+from datetime import datetime
 from tools import deprecated
 
 supported_types = set()
+_versions_table = '_sopel_versions'
+"""
+The table holding the version counters behind ``SopelDB.invalidate`` and
+``SopelDB.sync``. Like any name starting with ``_``, it is not set up as a
+``Table``.
+"""
+
+_schema_cache = {}
+"""
+Maps each database, by its type and location, to a tuple of a fingerprint of
+its schema and the schema last read from it. See ``SopelDB._load_schema``.
+"""
 #Attempt to import possible db modules
 try:
     import MySQLdb
@@ -33,6 +54,10 @@ try:
 except ImportError:
     pass
 
+import json
+from kvstore import KVStore
+supported_types.add('kv')
+
 
 class SopelDB(object):
     """
@@ -41,14 +66,17 @@ class SopelDB(object):
     chosen to back the SettingsDB, as determined by the ``userdb_type``
     attribute of *config*.
 
-    Currently, two values for ``userdb_type`` are supported: ``sqlite`` and
-    ``mysql``. The ``sqlite`` type requires that ``userdb_file`` be set in the
-    ``db`` section of ``config`` (that is, under the ``[db]`` heading in the
-    config file), and refer to a writeable sqlite database. The ``mysql`` type
-    requires ``userdb_host``, ``userdb_user``, ``userdb_pass``, and
-    ``userdb_name`` to be set, and provide the host and name of a MySQL
+    Currently, three values for ``userdb_type`` are supported: ``sqlite``,
+    ``mysql`` and ``kv``. The ``sqlite`` type requires that ``userdb_file`` be
+    set in the ``db`` section of ``config`` (that is, under the ``[db]``
+    heading in the config file), and refer to a writeable sqlite database. The
+    ``mysql`` type requires ``userdb_host``, ``userdb_user``, ``userdb_pass``,
+    and ``userdb_name`` to be set, and provide the host and name of a MySQL
     database, as well as a username and password for a user able to write to
-    said database.
+    said database. The ``kv`` type requires ``userdb_dir`` to be set to a
+    writeable directory, where each table is kept as a ``KVStore`` log. It
+    needs no SQL, and is meant for simple key-value data such as preferences;
+    see ``KVTable`` for what it does differently.
 
     Upon creation of the object, the tables currently existing in the given
     database will be registered, as though added through ``add_table``.
@@ -57,6 +85,46 @@ class SopelDB(object):
     def __init__(self, config):
         self._none = Table(self, '_none', [], '_none')
         self.tables = set()
+        self._local = threading.local()
+
+        self.io_thread = None
+        """
+        The thread running the bot's I/O loop, set once the bot connects. Any
+        query made from it stops the bot from reading or answering the server
+        until it completes, so such calls are counted in ``io_thread_calls``.
+        """
+        self.io_thread_calls = {}
+        """
+        A dict mapping the name of each module which has queried the
+        database from ``io_thread`` to the number of times it has done so.
+        Modules showing up here should move their queries to threaded
+        callables, or use ``submit``.
+        """
+
+        threads = timeout = threshold = None
+        if config.parser.has_section('db'):
+            threads = config.db.executor_threads
+            timeout = config.db.query_timeout
+            threshold = config.db.slow_query_threshold
+        if config.core.logdir:
+            slow_log = os.path.join(config.core.logdir, 'slow_queries.log')
+        else:
+            slow_log = None
+        self.metrics = QueryMetrics(float(threshold or 0.5), slow_log)
+        """
+        The ``QueryMetrics`` for every statement run on connections from
+        ``connect``, including those made by ``Table`` methods.
+        """
+
+        self.executor = DBExecutor(self, int(threads or 2),
+                                   float(timeout) if timeout else None)
+        """
+        The ``DBExecutor`` which runs calls passed to ``submit``.
+        """
+
+        self._versions = {}
+        self._watchers = {}
+
         if not config.parser.has_section('db'):
             self.type = None
             print 'No user settings database specified. Ignoring.'
@@ -75,6 +143,8 @@ class SopelDB(object):
         elif self.type == 'sqlite':
             self.substitution = '?'
             self._sqlite(config)
+        elif self.type == 'kv':
+            self._kv(config)
 
     def __getattr__(self, attr):
         """
@@ -109,21 +179,9 @@ class SopelDB(object):
             return
 
         #Set up existing tables and columns
-        cur = MySQLdb.cursors.DictCursor(db)
-        cur.execute("SHOW tables;")
-        tables = cur.fetchall()
-        for table in tables:
-            name = table['Tables_in_%s' % self._dbname]
-            cur.execute("SHOW columns FROM %s;" % name)
-            result = cur.fetchall()
-            columns = []
-            key = []
-            for column in result:
-                columns.append(column['Field'])
-                if column['Key'].startswith('PRI'):
-                    key.append(column['Field'])
-            setattr(self, name, Table(self, name, columns, key))
-            self.tables.add(name)
+        self._location = ('mysql', self._host, self._dbname)
+        self._load_versions(db)
+        self._register_schema(self._load_schema(db))
         db.close()
 
     def _sqlite(self, config):
@@ -141,25 +199,258 @@ class SopelDB(object):
             return
 
         #Set up existing tables and columns
+        self._location = ('sqlite', os.path.abspath(self._file))
+        self._load_versions(db)
+        self._register_schema(self._load_schema(db))
+        db.close()
+
+    def _kv(self, config):
+        self._dir = config.db.userdb_dir
+        if not self._dir:
+            print 'No directory specified for the key-value DB.' + \
+                ' The database will not be set up.'
+            return
+
+        try:
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
+        except OSError:
+            print 'Error: Unable to create the key-value DB directory.'
+            return
+
+        #Set up existing tables and columns
+        for filename in os.listdir(self._dir):
+            if not filename.endswith('.schema'):
+                continue
+            name = filename[:-len('.schema')]
+            with open(os.path.join(self._dir, filename)) as schema:
+                schema = json.load(schema)
+            indexes = dict((index, tuple(columns)) for index, columns
+                           in schema['indexes'].iteritems())
+            setattr(self, name, KVTable(self, name, schema['columns'],
+                                        schema['key'], indexes))
+            self.tables.add(name)
+
+    def _load_schema(self, db):
+        """
+        Return the schema of the database on connection ``db``, as a dict
+        mapping each table name to a tuple of its columns, its key columns,
+        and a dict of its secondary indexes.
+
+        The schema is cached for the life of the process, along with a cheap
+        fingerprint of it. As long as the fingerprint read from the database
+        still matches, reconnecting reuses the cached schema, no matter how
+        many tables there are. On sqlite, this is the ``schema_version``
+        pragma. MySQL has nothing as cheap, since going through
+        information_schema can take seconds on a busy server, so the
+        ``'schema'`` version which ``invalidate`` keeps is used instead. This
+        relies on tables being changed through ``SopelDB``; changes made by
+        hand are only picked up once something invalidates ``'schema'``.
+        """
         cur = db.cursor()
-        cur.execute("SELECT * FROM sqlite_master;")
-        tables = cur.fetchall()
-        for table in tables:
-            name = table[1]
+        if self.type == 'mysql':
+            # _load_versions and sync read the versions just before this.
+            fingerprint = ('schema', self._versions.get('schema', 0))
+        else:
+            cur.execute("PRAGMA schema_version;")
+            fingerprint = tuple(cur.fetchone())
+
+        cached = _schema_cache.get(self._location)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        if self.type == 'mysql':
+            schema = self._introspect_mysql(cur)
+        else:
+            schema = self._introspect_sqlite(cur)
+        _schema_cache[self._location] = (fingerprint, schema)
+        return schema
+
+    def _introspect_mysql(self, cur):
+        # information_schema gives every table's columns and indexes in two
+        # queries, where SHOW columns and SHOW INDEX take two per table.
+        schema = {}
+        cur.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_KEY"
+            " FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s"
+            " ORDER BY TABLE_NAME, ORDINAL_POSITION;",
+            (self._dbname,)
+        )
+        for name, column, key in cur.fetchall():
+            columns, keys, indexes = schema.setdefault(name, ([], [], {}))
+            columns.append(column)
+            if key.startswith('PRI'):
+                keys.append(column)
+        cur.execute(
+            "SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME"
+            " FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s"
+            " AND INDEX_NAME != 'PRIMARY'"
+            " ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;",
+            (self._dbname,)
+        )
+        for name, index, column in cur.fetchall():
+            if name in schema:
+                indexes = schema[name][2]
+                indexes[index] = indexes.get(index, ()) + (column,)
+        return schema
+
+    def _introspect_sqlite(self, cur):
+        schema = {}
+        try:
+            # The table-valued pragma functions (SQLite 3.16+) let us read
+            # every table in one query.
+            cur.execute(
+                "SELECT m.name, p.name, p.pk FROM sqlite_master AS m"
+                " JOIN pragma_table_info(m.name) AS p"
+                " WHERE m.type = 'table' ORDER BY m.name, p.cid;"
+            )
+            table_info = cur.fetchall()
+            cur.execute(
+                "SELECT m.name, l.name, i.name FROM sqlite_master AS m"
+                " JOIN pragma_index_list(m.name) AS l"
+                " JOIN pragma_index_info(l.name) AS i"
+                " WHERE m.type = 'table' ORDER BY m.name, l.name, i.seqno;"
+            )
+            index_info = cur.fetchall()
+        except sqlite3.OperationalError:
+            table_info = []
+            index_info = []
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+            for (name,) in cur.fetchall():
+                cur.execute("PRAGMA table_info(%s);" % name)
+                for column in cur.fetchall():
+                    table_info.append((name, column[1], column[5]))
+                cur.execute("PRAGMA index_list(%s);" % name)
+                for index in cur.fetchall():
+                    cur.execute("PRAGMA index_info(%s);" % index[1])
+                    for column in sorted(cur.fetchall()):
+                        index_info.append((name, index[1], column[2]))
+
+        for name, column, pk in table_info:
             if name.startswith('sqlite_'):
                 continue
+            columns, keys, indexes = schema.setdefault(name, ([], [], {}))
+            columns.append(column)
+            if pk:
+                keys.append((pk, column))
+        for columns, keys, indexes in schema.itervalues():
+            keys[:] = [column for _, column in sorted(keys)]
+        for name, index, column in index_info:
+            if name in schema and not index.startswith('sqlite_'):
+                indexes = schema[name][2]
+                indexes[index] = indexes.get(index, ()) + (column,)
+        return schema
+
+    def _register_schema(self, schema):
+        """
+        Set up a ``Table`` for each table in ``schema``. Tables which are
+        already set up are updated in place, so references to them held by
+        modules stay valid, and tables which are no longer in ``schema`` are
+        removed.
+        """
+        for name, (columns, key, indexes) in schema.iteritems():
+            if name.startswith('_'):
+                continue
+            table = Table(self, name, columns, key, indexes)
+            if name in self.tables:
+                extant_table = getattr(self, name)
+                extant_table.columns = table.columns
+                extant_table.key = table.key
+                extant_table.keyless = table.keyless
+                extant_table.indexes = table.indexes
+            else:
+                setattr(self, name, table)
+                self.tables.add(name)
+        for name in list(self.tables):
+            if name not in schema:
+                delattr(self, name)
+                self.tables.discard(name)
+
+    def _load_versions(self, db):
+        cur = db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + _versions_table +
+                    ' (name VARCHAR(255) PRIMARY KEY,'
+                    ' version INTEGER NOT NULL);')
+        cur.execute('SELECT name, version FROM ' + _versions_table)
+        self._versions = dict(cur.fetchall())
+        db.commit()
 
-            cur.execute("PRAGMA table_info(%s);" % name)
-            result = cur.fetchall()
-            columns = []
-            key = []
-            for column in result:
-                columns.append(column[1])
-                if column[3]:
-                    key.append(column[1])
-            setattr(self, name, Table(self, name, columns, key))
+    def invalidate(self, name):
+        """
+        Tell every bot sharing this database that whatever ``name`` refers to
+        has changed, so they should drop anything they have cached about it.
+        They find out the next time they ``sync``, and run the callbacks they
+        registered for ``name`` with ``watch``.
+
+        This is how the column and index caches of each ``Table`` are kept up
+        to date: ``add_table``, ``Table.add_columns`` and ``Table.add_index``
+        invalidate ``'schema'``. Modules which cache rows can do the same with
+        a name of their own, such as that of the table.
+        """
+        if self.type not in ('sqlite', 'mysql'):
+            return
+        if self.type == 'mysql':
+            insert = 'INSERT IGNORE INTO '
+        else:
+            insert = 'INSERT OR IGNORE INTO '
+        subst = self.substitution
+        db = self.connect()
+        cur = db.cursor()
+        cur.execute(insert + _versions_table + ' (name, version) VALUES (' +
+                    subst + ', 0)', [name])
+        select = 'SELECT version FROM ' + _versions_table + \
+            ' WHERE name = ' + subst
+        if self.type == 'mysql':
+            select += ' FOR UPDATE'
+        cur.execute(select, [name])
+        old = cur.fetchone()[0]
+        cur.execute('UPDATE ' + _versions_table +
+                    ' SET version = version + 1 WHERE name = ' + subst, [name])
+        db.commit()
+        db.close()
+        # This process already knows about its own change, but only skip
+        # ahead if it had seen every earlier one. Otherwise the next ``sync``
+        # must still pick up the others.
+        if self._versions.get(name, 0) == old:
+            self._versions[name] = old + 1
+
+    def watch(self, name, callback):
+        """
+        Call ``callback(name)`` from ``sync`` whenever another bot sharing
+        this database calls ``invalidate`` with ``name``.
+        """
+        self._watchers.setdefault(name, []).append(callback)
+
+    def sync(self):
+        """
+        Check whether other bots sharing this database have invalidated
+        anything since the last check, and return the names which changed.
+        This is a single query on a small table, so it is cheap enough to run
+        every few seconds; the ``coretasks`` module does so.
+
+        If the schema changed, the ``Table`` objects are brought up to date,
+        and any new tables are set up. Then the callbacks registered with
+        ``watch`` for each changed name are run.
+        """
+        if self.type not in ('sqlite', 'mysql'):
+            return []
+        db = self.connect()
+        cur = db.cursor()
+        cur.execute('SELECT name, version FROM ' + _versions_table)
+        changed = []
+        for name, version in cur.fetchall():
+            if self._versions.get(name) != version:
+                self._versions[name] = version
+                changed.append(name)
+        if 'schema' in changed:
+            self._register_schema(self._load_schema(db))
         db.close()
 
+        for name in changed:
+            for callback in self._watchers.get(name, []):
+                callback(name)
+        return changed
+
     def check_table(self, name, columns, key):
         """
         Return ``True`` if the SopelDB contains a table with the same ``name``
@@ -180,6 +471,7 @@ class SopelDB(object):
                     cols = cols + column + ' string'
             elif isinstance(column, tuple):
                 cols += '%s %s' % column
+                column = column[0]
 
             if key and column in key:
                 cols += ' NOT NULL'
@@ -194,7 +486,8 @@ class SopelDB(object):
             cols = cols[:-2]
         return cols + ')'
 
-    def add_table(self, name, columns, key):
+    def add_table(self, name, columns, key, indexes=None, ttl_column=None,
+                  ttl=None):
         """
         Add a column with the given ``name`` and ``key``, which has the given
         ``columns``. Each element in ``columns`` may be either a string giving
@@ -207,6 +500,19 @@ class SopelDB(object):
         SopelDB object. If a table with the same name and key already exists,
         the given columns will be added (if they don't already exist).
 
+        ``indexes`` may be a list of secondary indexes to create on the table,
+        each given as a column name or a tuple of column names. Indexes which
+        already exist are left alone; see ``Table.add_index``.
+
+        If ``ttl_column`` and ``ttl`` are given, rows expire ``ttl`` seconds
+        after they were last written. ``update`` and ``update_many`` store the
+        time of each write in ``ttl_column`` (an integer column, which is
+        created and indexed if needed), and ``expire`` deletes the rows which
+        have gone stale. Rows already in the table with no time in
+        ``ttl_column`` are treated as if they were written now. The TTL is not
+        stored in the database, so it must be given every time the table is
+        added.
+
         The given ``name`` can not be the same as any function or attribute
         (with the exception of other tables) of the ``SopelDB`` object, nor
         may it start with ``'_'``. If it does not meet this requirement, or if
@@ -222,6 +528,14 @@ class SopelDB(object):
         # table, but we want to know if the table already exists or if it's
         # some other db attribute.
         extant_table = getattr(self, name)
+        if ttl_column:
+            if ttl is None:
+                raise ValueError('A ttl_column needs a ttl.')
+            columns = [c for c in columns
+                       if (c[0] if isinstance(c, tuple) else c) != ttl_column]
+            columns.append((ttl_column, 'INTEGER'))
+            indexes = list(indexes or []) + [ttl_column]
+        names = [c[0] if isinstance(c, tuple) else c for c in columns]
         if name.startswith('_'):  # exclude special names
             raise ValueError('Invalid table name %s.' % name)
         elif not isinstance(extant_table, Table):
@@ -230,45 +544,627 @@ class SopelDB(object):
         elif not name in self.tables:
             # We got a table, but it's not registered in the table list, so we
             # create it.
-            cols = self._get_column_creation_text(columns, key)
-            db = self.connect()
-            cursor = db.cursor()
-            cursor.execute("CREATE TABLE %s %s;" % (name, cols))
-            db.close()
-            extant_table = Table(self, name, columns, key)
+            if self.type == 'kv':
+                extant_table = KVTable(self, name, names, key)
+                extant_table._save_schema()
+            else:
+                cols = self._get_column_creation_text(columns, key)
+                db = self.connect()
+                cursor = db.cursor()
+                cursor.execute("CREATE TABLE %s %s;" % (name, cols))
+                db.close()
+                extant_table = Table(self, name, names, key)
+                self.invalidate('schema')
             setattr(self, name, extant_table)
             self.tables.add(name)
-        elif extant_table.key == key:
+        elif extant_table.key == key or (extant_table.keyless and not key):
             # We got an actual table. If the key on the table being created
             # has the same key, it's safe to assume it's the one the user
             # wanted, so if there are columns not already there, we add them.
-            if not all(c in extant_table.columns for c in columns):
-                db = self.connect()
-                cursor = db.cursor()
-                cursor.execute("ALTER TABLE %s ADD COLUMN %s;")
-                extant_table.colums.add(columns)
-                db.close()
+            missing = [c for c, n in zip(columns, names)
+                       if n not in extant_table.columns]
+            if missing:
+                extant_table.add_columns(missing)
         else:
             # There's already a different table with that name, which we can't
             # fix, so raise an error.
             raise ValueError('Table %s already exists with different key.'
                              % name)
 
+        for index in indexes or []:
+            extant_table.add_index(index)
+
+        if ttl_column:
+            extant_table.ttl_column = ttl_column
+            extant_table.ttl = ttl
+            extant_table._stamp_unset()
+
+    def expire(self, batch_size=None):
+        """
+        Delete the expired rows from every table with a TTL, as described in
+        ``add_table``. Return a dict mapping the name of each table which had
+        expired rows to how many were deleted. See ``Table.expire`` for how
+        ``batch_size`` is used.
+        """
+        purged = {}
+        for name in sorted(self.tables):
+            table = getattr(self, name)
+            if table.ttl_column:
+                count = table.expire(batch_size)
+                if count:
+                    purged[name] = count
+        return purged
+
     def connect(self):
         """
         Create a database connection object. This functions essentially the
         same as the ``connect`` function of the appropriate database type,
-        allowing for custom queries to be executed.
+        allowing for custom queries to be executed. Statements run through
+        it are timed and counted in ``metrics``.
+
+        Within a ``transaction`` on the calling thread, the transaction's
+        connection is returned instead, and closing or committing it does
+        nothing.
         """
+        pinned = getattr(self._local, 'transaction', None)
+        if pinned is not None:
+            return pinned
+
+        if (self.io_thread is not None and
+                threading.current_thread() is self.io_thread):
+            caller = _caller_module()
+            self.io_thread_calls[caller] = \
+                self.io_thread_calls.get(caller, 0) + 1
+
         if self.type == 'mysql':
-            return MySQLdb.connect(
+            db = MySQLdb.connect(
                 host=self._host,
                 user=self._user,
                 passwd=self._passwd,
                 db=self._dbname
             )
         elif self.type == 'sqlite':
-            return sqlite3.connect(self._file)
+            db = sqlite3.connect(self._file)
+            deadline = getattr(self._local, 'deadline', None)
+            if deadline is not None:
+                # Abort statements still running when a submitted call's
+                # timeout runs out. The handler is called every 1000 VM
+                # instructions, and a true result interrupts the query.
+                db.set_progress_handler(
+                    lambda: time.time() > deadline, 1000)
+        else:
+            return None
+        return _Connection(db, self.metrics)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group ``Table`` calls into a single transaction::
+
+            with bot.db.transaction():
+                bot.db.preferences.update(nick, {'tz': tz})
+                bot.db.preferences.delete(old_nick)
+
+        Every call made on this thread inside the ``with`` block uses the same
+        connection, and is committed once when the block ends. If an exception
+        propagates out of the block, everything is rolled back instead, so the
+        changes are applied all together or not at all. Nested transactions
+        are folded into the outermost one. The connection is what ``as``
+        binds, for running custom queries in the same transaction.
+
+        On the ``kv`` type there are no transactions to roll back, so this
+        only holds back flushing the tables' logs until the block ends.
+        """
+        pinned = getattr(self._local, 'transaction', None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        if self.type == 'kv':
+            stores = [getattr(self, name)._store for name in self.tables]
+            for store in stores:
+                store.begin()
+            try:
+                yield None
+            finally:
+                for store in stores:
+                    store.end()
+            return
+
+        db = self.connect()
+        if db is None:
+            yield None
+            return
+        self._local.transaction = _PinnedConnection(db)
+        try:
+            yield self._local.transaction
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            self._local.transaction = None
+            db.close()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` on one of the ``executor``'s threads,
+        and return a ``DBFuture`` for its result. This is meant for calling
+        ``Table`` methods from callables which do not run in their own thread,
+        so the bot is not stalled while the query runs::
+
+            future = bot.db.submit(bot.db.preferences.get, nick, 'tz')
+            future.add_done_callback(lambda f: bot.say(f.result()))
+
+        A ``timeout`` keyword argument, in seconds, overrides the executor's
+        default for this call.
+        """
+        return self.executor.submit(func, *args, **kwargs)
+
+    def close(self):
+        """
+        Shut down the ``executor``, once the calls already queued on it are
+        done, and close the tables of a ``kv`` database, releasing the locks
+        on their logs so that another SopelDB can open them. The SopelDB must
+        not be used afterwards.
+        """
+        self.executor.shutdown(wait=True)
+        if self.type == 'kv':
+            for name in self.tables:
+                getattr(self, name)._store.close()
+
+    def streaming_cursor(self, db):
+        """
+        Return a cursor on the connection ``db`` which does not buffer the
+        whole result set on the client. Rows are only transferred as they are
+        fetched, so large results can be read with ``fetchmany`` in constant
+        memory. On MySQL, no other query may be run on ``db`` until every row
+        has been fetched or the cursor is closed.
+        """
+        if self.type == 'mysql':
+            return db.cursor(MySQLdb.cursors.SSCursor)
+        return db.cursor()
+
+
+def _caller_module():
+    """
+    Return the name of the module which called into this one, by walking up
+    the stack past any frames that belong to this module.
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return __name__
+    return frame.f_globals.get('__name__', '?')
+
+
+def _is_read(statement):
+    """Return ``True`` if ``statement`` only reads from the database."""
+    return statement.lstrip()[:6].upper() in ('SELECT', 'PRAGMA', 'SHOW')
+
+
+class QueryMetrics(object):
+    """
+    Timing and row counts for the statements run on a SopelDB, kept per table
+    and per calling module. Statements which take at least ``threshold``
+    seconds are also written to the file ``slow_log``, if given, along with
+    the module which ran them.
+    """
+
+    buckets = (0.001, 0.01, 0.1, 1.0)
+    """
+    The upper bounds, in seconds, of the latency histogram's buckets. One
+    more bucket counts the statements slower than the last bound.
+    """
+
+    _table = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+'
+                        r'(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.I)
+
+    def __init__(self, threshold=0.5, slow_log=None):
+        self.threshold = threshold
+        self.slow_log = slow_log
+        self.tables = {}
+        """
+        A dict mapping table names to dicts with the ``reads``, ``writes``,
+        ``rows`` and total ``time`` of the statements on that table, and a
+        ``histogram`` list with a count for each of the ``buckets``.
+        """
+        self.modules = {}
+        """
+        A dict mapping the names of calling modules to a list of the number
+        of statements they ran and the total time those took.
+        """
+        self._lock = threading.Lock()
+
+    def record(self, statement, elapsed, rows, caller):
+        """
+        Count one ``statement`` which took ``elapsed`` seconds and read or
+        changed ``rows`` rows, on behalf of the module named ``caller``.
+        """
+        match = self._table.search(statement)
+        if match:
+            name = match.group(1)
+        else:
+            name = '-'
+        write = not _is_read(statement)
+        bucket = 0
+        while bucket < len(self.buckets) and elapsed >= self.buckets[bucket]:
+            bucket += 1
+
+        with self._lock:
+            table = self.tables.get(name)
+            if table is None:
+                table = self.tables[name] = {
+                    'reads': 0, 'writes': 0, 'rows': 0, 'time': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+            table['writes' if write else 'reads'] += 1
+            table['rows'] += max(rows, 0)
+            table['time'] += elapsed
+            table['histogram'][bucket] += 1
+            module = self.modules.setdefault(caller, [0, 0.0])
+            module[0] += 1
+            module[1] += elapsed
+
+        # Written outside the lock, so a slow disk only holds up this thread.
+        if self.slow_log and elapsed >= self.threshold:
+            try:
+                with open(self.slow_log, 'a') as log:
+                    log.write('%s\t%.1fms\t%s\t%d rows\t%s\n' % (
+                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        elapsed * 1000, caller, rows,
+                        ' '.join(statement.split())
+                    ))
+            except IOError:
+                pass
+
+    def labels(self):
+        """Return a short label for each bucket of the latency histogram."""
+        labels = []
+        for bound in self.buckets:
+            if bound < 1:
+                labels.append('<%gms' % (bound * 1000))
+            else:
+                labels.append('<%gs' % bound)
+        bound = self.buckets[-1]
+        if bound < 1:
+            labels.append('>=%gms' % (bound * 1000))
+        else:
+            labels.append('>=%gs' % bound)
+        return labels
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self.tables = {}
+            self.modules = {}
+
+
+class _Cursor(object):
+    """
+    Wraps a DB-API cursor to report each statement to a ``QueryMetrics``.
+    Time spent fetching a statement's results, and the rows fetched, are
+    counted towards it; it is recorded when the next statement is run or
+    the cursor is closed.
+    """
+
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._statement = None
+
+    def _start(self, statement):
+        self._finish()
+        self._statement = statement
+        self._read = _is_read(statement)
+        self._caller = _caller_module()
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _finish(self):
+        if self._statement is not None:
+            self._metrics.record(self._statement, self._elapsed, self._rows,
+                                 self._caller)
+            self._statement = None
+
+    def _timed(self, func, *args):
+        started = time.time()
+        try:
+            return func(*args)
+        finally:
+            if self._statement is not None:
+                self._elapsed += time.time() - started
+
+    def execute(self, statement, *args):
+        self._start(statement)
+        result = self._timed(self._cursor.execute, statement, *args)
+        # Rows a query returns are counted as they are fetched.
+        if not self._read and self._cursor.rowcount > 0:
+            self._rows += self._cursor.rowcount
+        return result
+
+    def executemany(self, statement, *args):
+        self._start(statement)
+        result = self._timed(self._cursor.executemany, statement, *args)
+        if not self._read and self._cursor.rowcount > 0:
+            self._rows += self._cursor.rowcount
+        return result
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None and self._statement is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(self._cursor.fetchmany, *args)
+        if self._statement is not None:
+            self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        if self._statement is not None:
+            self._rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class _Connection(object):
+    """
+    Wraps a DB-API connection so that its cursors report to a
+    ``QueryMetrics``, as do statements run with sqlite's ``execute`` and
+    ``executemany`` shortcuts. Anything else is passed through to the
+    connection.
+    """
+
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+        self._cursors = []
+
+    def _wrap(self, cursor):
+        cursor = _Cursor(cursor, self._metrics)
+        self._cursors.append(cursor)
+        return cursor
+
+    def cursor(self, *args):
+        return self._wrap(self._db.cursor(*args))
+
+    def execute(self, statement, *args):
+        cursor = self.cursor()
+        cursor.execute(statement, *args)
+        return cursor
+
+    def executemany(self, statement, *args):
+        cursor = self.cursor()
+        cursor.executemany(statement, *args)
+        return cursor
+
+    def __enter__(self):
+        entered = self._db.__enter__()
+        if entered is self._db:
+            return self
+        # MySQLdb gives a cursor to use inside the block.
+        return self._wrap(entered)
+
+    def __exit__(self, *exc_info):
+        return self._db.__exit__(*exc_info)
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor._finish()
+        self._cursors = []
+        self._db.close()
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
+
+
+class _PinnedConnection(object):
+    """
+    The connection handed out by ``connect`` during a transaction. Committing,
+    rolling back and closing are left to the transaction itself.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
+
+
+class DBTimeoutError(Exception):
+    """
+    Raised by ``DBFuture.result`` when a call submitted to a ``DBExecutor``
+    did not finish within its timeout, including when a SQLite query it made
+    was aborted for running over.
+    """
+
+
+class DBFuture(object):
+    """
+    The pending result of a call submitted to a ``DBExecutor``.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        """The number of seconds the call may take, or ``None``."""
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return ``True`` if the call has finished, or failed."""
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise DBTimeoutError('Database call did not finish in %ss.'
+                                 % timeout)
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result, or raise the
+        exception it raised. ``DBTimeoutError`` is raised if it takes longer
+        than ``timeout`` seconds, which defaults to the call's own timeout.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish, like ``result``, and return the exception
+        it raised, or ``None``.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, func):
+        """
+        Call ``func`` with this future once the call has finished. If it
+        already has, ``func`` is called right away. Otherwise it will be
+        called from the executor thread which ran the call.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                pass
+
+
+class DBExecutor(object):
+    """
+    A small pool of threads which run calls on the SopelDB ``db``, so that
+    callers do not have to wait on them. The ``threads`` are started the first
+    time a call is submitted. If ``timeout`` is given, it is the default number
+    of seconds a call may take, counting any time spent waiting for a free
+    thread. On SQLite, a query still running when the time is up is aborted;
+    on MySQL, the caller stops waiting but the query runs to completion.
+    """
+
+    def __init__(self, db, threads=2, timeout=None):
+        self.db = db
+        self.threads = threads
+        self.timeout = timeout
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)`` to be run and return a ``DBFuture``
+        for its result. A ``timeout`` keyword argument is taken as the number
+        of seconds allowed for this call, rather than passed on to ``func``.
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        future = DBFuture(timeout)
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+        with self._lock:
+            if not self._workers:
+                for i in range(self.threads):
+                    worker = threading.Thread(target=self._work,
+                                              name='DBExecutor-%d' % i)
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+        self._queue.put((future, deadline, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=False):
+        """
+        Stop the worker threads once the calls already queued are done, and
+        if ``wait`` is true, wait for that. The executor can be used again
+        afterwards; new threads will be started.
+        """
+        with self._lock:
+            workers = self._workers
+            for worker in workers:
+                self._queue.put(None)
+            self._workers = []
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, deadline, func, args, kwargs = item
+            if deadline is not None and time.time() > deadline:
+                future._finish(exc_info=(
+                    DBTimeoutError,
+                    DBTimeoutError('Database call timed out while queued.'),
+                    None
+                ))
+                continue
+            # Let SopelDB.connect() bound the queries this call makes.
+            self.db._local.deadline = deadline
+            try:
+                future._finish(result=func(*args, **kwargs))
+            except Exception:
+                exc_info = sys.exc_info()
+                if (self.db.type == 'sqlite' and
+                        isinstance(exc_info[1], sqlite3.OperationalError) and
+                        str(exc_info[1]) == 'interrupted'):
+                    # The query was aborted by SopelDB.connect()'s progress
+                    # handler, since the time was up.
+                    exc_info = (DBTimeoutError, DBTimeoutError(
+                        'Database call did not finish in %ss.'
+                        % future.timeout), exc_info[2])
+                future._finish(exc_info=exc_info)
+            finally:
+                self.db._local.deadline = None
 
 
 class Table(object):
@@ -281,21 +1177,65 @@ class Table(object):
     an Exception will be thrown.
     """
 
-    def __init__(self, db, name, columns, key):
+    chunk_size = 500
+    """
+    The largest number of rows ``get_many`` and ``update_many`` will match in
+    a single statement. SQLite limits a statement to 999 parameters by
+    default, so this should not be raised much further.
+    """
+
+    fetch_size = 1000
+    """
+    The default number of rows ``iter_rows`` and ``iter_keys`` fetch from the
+    database at a time.
+    """
+
+    expire_batch_size = 500
+    """
+    The default number of rows ``expire`` deletes in each transaction. Keeping
+    this small keeps each write lock short, so other queries can go between
+    the batches.
+    """
+
+    index_prefix = 191
+    """
+    How many characters of a ``TEXT`` or ``BLOB`` column MySQL indexes, since
+    it cannot index them whole. 191 four-byte characters fit the 767-byte key
+    limit of older InnoDB tables.
+    """
+
+    ttl_column = None
+    """The column holding the time each row was written, if it has a TTL."""
+    ttl = None
+    """How many seconds after they were written rows expire, if at all."""
+    keyless = False
+    """
+    Whether the table was made without a primary key, in which case ``key`` is
+    just its first column, and need not be unique.
+    """
+
+    def __init__(self, db, name, columns, key, indexes=None):
         #This lets us have a pseudo-table to handle a non-existant table
         if name is '_none':
             self.db = db
             self.columns = set()
+            self.indexes = {}
             self.name = name
             self.key = '_none'
             return
         if not key:
             key = columns[0]
+            self.keyless = True
         if len(key) == 1:
             key = key[0]  # This catches strings, too, but without consequence.
 
         self.db = db
         self.columns = set(columns)
+        self.indexes = dict(indexes or {})
+        """
+        A cache of the secondary indexes on the table, mapping the name of
+        each index to a tuple of the columns it covers.
+        """
         self.name = name
         if isinstance(key, basestring):
             if key not in columns:
@@ -310,24 +1250,40 @@ class Table(object):
     def __nonzero__(self):
         return bool(self.columns)
 
-    def users(self):
+    def _count_key_ranges(self, where, bounds):
         """
-        Returns the number of users (entries not starting with # or &) in the
-        table's ``key`` column.
+        Count the rows whose first key column falls in the ranges given by
+        ``where``. Comparing against bounds, rather than using ``LIKE``, lets
+        both backends answer from the primary key's index.
         """
-        if not self.columns:  # handle a non-existant table
-            return 0
-
+        if isinstance(self.key, basestring):
+            key = self.key
+        else:
+            key = self.key[0]
         db = self.db.connect()
         cur = db.cursor()
         cur.execute(
-            "SELECT COUNT(*) FROM " + self.name +
-            " WHERE " + self.key + " LIKE \"[^#&]%;"
+            "SELECT COUNT(*) FROM " + self.name + " WHERE " +
+            where.format(key=key, s=self.db.substitution),
+            bounds
         )
         result = int(cur.fetchone()[0])
         db.close()
         return result
 
+    def users(self):
+        """
+        Returns the number of users (entries not starting with # or &) in the
+        table's ``key`` column.
+        """
+        if not self.columns:  # handle a non-existant table
+            return 0
+        # '$' and "'" are the characters right after '#' and '&'.
+        return self._count_key_ranges(
+            "{key} < {s} OR ({key} >= {s} AND {key} < {s}) OR {key} >= {s}",
+            ['#', '$', '&', "'"]
+        )
+
     def channels(self):
         """
         Returns the number of users (entries starting with # or &) in the
@@ -335,16 +1291,10 @@ class Table(object):
         """
         if not self.columns:  # handle a non-existant table
             return 0
-
-        db = self.db.connect()
-        cur = db.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM " + self.name +
-            " WHERE " + self.key + " LIKE \"[#&]%;"
+        return self._count_key_ranges(
+            "({key} >= {s} AND {key} < {s}) OR ({key} >= {s} AND {key} < {s})",
+            ['#', '$', '&', "'"]
         )
-        result = int(cur.fetchone()[0])
-        db.close()
-        return result
 
     def size(self):
         """Returns the total number of rows in the table."""
@@ -446,6 +1396,7 @@ class Table(object):
         """
         if not self.columns:  # handle a non-existant table
             raise ValueError('Table is empty.')
+        values = self._stamp(values)
 
         if isinstance(row, basestring):
             rowl = [row]
@@ -473,6 +1424,288 @@ class Table(object):
         db.commit()
         db.close()
 
+    def _stamp(self, values):
+        """
+        Return ``values`` with the current time set in ``ttl_column``, if the
+        table has a TTL. The time is a string, since ``update`` builds its
+        statements by concatenation.
+        """
+        if not self.ttl_column or self.ttl_column in values:
+            return values
+        values = dict(values)
+        values[self.ttl_column] = str(int(time.time()))
+        return values
+
+    def _stamp_unset(self):
+        """Set the current time on rows which have none in ``ttl_column``."""
+        db = self.db.connect()
+        cur = db.cursor()
+        cur.execute('UPDATE ' + self.name + ' SET ' + self.ttl_column +
+                    ' = ' + self.db.substitution + ' WHERE ' +
+                    self.ttl_column + ' IS NULL', [int(time.time())])
+        db.commit()
+        db.close()
+
+    def expire(self, batch_size=None, max_batches=None):
+        """
+        Delete the rows which were last written more than ``ttl`` seconds ago,
+        and return how many were deleted. Nothing is done if the table has no
+        TTL.
+
+        Rows are deleted ``batch_size`` (by default ``expire_batch_size``) at
+        a time, each batch in its own short transaction, so the table is never
+        locked for the whole sweep. If ``max_batches`` is given, at most that
+        many batches are deleted, and the rest are left for the next call.
+        """
+        if not self.columns or not self.ttl_column:
+            return 0
+
+        batch_size = int(batch_size or self.expire_batch_size)
+        cutoff = int(time.time() - self.ttl)
+        where = self.ttl_column + ' < ' + self.db.substitution
+        if self.db.type == 'mysql':
+            command = 'DELETE FROM ' + self.name + ' WHERE ' + where + \
+                ' LIMIT %d' % batch_size
+        else:
+            # SQLite only has DELETE ... LIMIT when built with an option for
+            # it, so pick the batch by rowid instead.
+            command = 'DELETE FROM ' + self.name + ' WHERE rowid IN ' + \
+                '(SELECT rowid FROM ' + self.name + ' WHERE ' + where + \
+                ' LIMIT %d)' % batch_size
+
+        purged = 0
+        batches = 0
+        db = self.db.connect()
+        try:
+            cur = db.cursor()
+            while max_batches is None or batches < max_batches:
+                cur.execute(command, [cutoff])
+                deleted = cur.rowcount
+                db.commit()
+                purged += deleted
+                batches += 1
+                if deleted < batch_size:
+                    break
+        finally:
+            db.close()
+        return purged
+
+    def _make_in_statement(self, key, count):
+        """
+        Return a ``WHERE`` clause matching ``count`` rows at once on the
+        ``key`` column(s), for use with a flat list of row values.
+        """
+        subst = self.db.substitution
+        if isinstance(key, basestring):
+            return key + ' IN (' + ', '.join([subst] * count) + ')'
+        match = '(' + ' AND '.join(k + ' = ' + subst for k in key) + ')'
+        return ' OR '.join([match] * count)
+
+    def _chunks(self, rows, key):
+        """
+        Split ``rows`` into lists small enough to stay under the backends'
+        limits on the number of parameters in one statement.
+        """
+        if isinstance(key, basestring):
+            size = self.chunk_size
+        else:
+            size = max(1, self.chunk_size // len(key))
+        for i in xrange(0, len(rows), size):
+            yield rows[i:i + size]
+
+    def _flatten_rows(self, rows, key):
+        if isinstance(key, basestring):
+            return list(rows)
+        params = []
+        for row in rows:
+            if len(row) != len(key):
+                raise ValueError('Unequal number of key and row columns.')
+            params.extend(row)
+        return params
+
+    def get_many(self, rows, columns, key=None):
+        """
+        Retrieve the value(s) in one or more ``columns`` for each of the given
+        ``rows``, using as few queries as possible. The same rules regarding
+        ``row``, ``columns`` and ``key`` apply as for ``get``, except that
+        ``rows`` is an iterable of such row values.
+
+        Return a dict mapping each row, as stored in the ``key`` column(s), to
+        what ``get`` would have returned for it. Rows that are not in the
+        table are left out of the dict rather than raising a ``KeyError``.
+        """
+        if not self.columns:  # handle a non-existant table
+            return {}
+
+        if not key:
+            key = self.key
+        if isinstance(key, basestring):
+            key_columns = [key]
+        else:
+            key_columns = list(key)
+        single = isinstance(columns, basestring)
+        if single:
+            columns = [columns]
+        else:
+            columns = list(columns)
+
+        rows = list(set(r if isinstance(r, basestring) else tuple(r)
+                        for r in rows))
+        select = 'SELECT ' + ', '.join(key_columns + columns) + \
+            ' FROM ' + self.name + ' WHERE '
+        width = len(key_columns)
+        result = {}
+        db = self.db.connect()
+        cur = db.cursor()
+        for chunk in self._chunks(rows, key):
+            cur.execute(select + self._make_in_statement(key, len(chunk)),
+                        self._flatten_rows(chunk, key))
+            for found in cur.fetchall():
+                if width == 1:
+                    row = found[0]
+                else:
+                    row = tuple(found[:width])
+                if single:
+                    result[row] = found[width]
+                else:
+                    result[row] = tuple(found[width:])
+        db.close()
+        return result
+
+    def update_many(self, mapping, key=None):
+        """
+        Update many rows at once. ``mapping`` is a dict of row values (as
+        passed to ``update``) to dicts of column name to new value. Rows which
+        do not exist will be created.
+
+        All the changes are written in batches within a single transaction,
+        so either every row is updated or, if an error occurs, none are.
+        Return a dict mapping each row to ``True`` if it was created, or
+        ``False`` if it already existed and was updated.
+
+        Whether a row already exists is left to the database, so that its
+        collation decides if, say, ``Bob`` and ``bob`` are the same row. On
+        MySQL, rows are written with ``INSERT ... ON DUPLICATE KEY UPDATE``
+        when ``key`` is the table's own key. On sqlite, each row is updated,
+        and inserted if that matched nothing.
+        """
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+        if not mapping:
+            return {}
+        if self.ttl_column:
+            mapping = dict((row, self._stamp(values))
+                           for row, values in mapping.iteritems())
+
+        if not key:
+            key = self.key
+        if isinstance(key, basestring):
+            key_columns = [key]
+        else:
+            key_columns = list(key)
+        if isinstance(self.key, basestring):
+            upsert = key_columns == [self.key]
+        else:
+            upsert = sorted(key_columns) == sorted(self.key)
+        mysql = self.db.type == 'mysql'
+        subst = self.db.substitution
+        where = ' AND '.join(k + ' = ' + subst for k in key_columns)
+
+        # executemany needs the same statement for every row, so group
+        # the rows by the set of columns being written.
+        groups = {}
+        for row, values in mapping.iteritems():
+            if isinstance(row, basestring):
+                row_values = [row]
+            else:
+                row_values = list(row)
+            if len(row_values) != len(key_columns):
+                raise ValueError('Unequal number of key and row columns.')
+            cols = tuple(sorted(values))
+            groups.setdefault(cols, []).append(
+                (row, row_values, [values[c] for c in cols]))
+
+        result = {}
+        db = self.db.connect()
+        try:
+            cur = db.cursor()
+            if mysql:
+                existing = self._existing(cur, list(mapping), key_columns)
+            for cols, group in groups.iteritems():
+                names = key_columns + list(cols)
+                insert = 'INSERT INTO ' + self.name + ' (' + \
+                    ', '.join(names) + ') VALUES (' + \
+                    ', '.join([subst] * len(names)) + ')'
+                if cols:
+                    assign = ', '.join(c + ' = ' + subst for c in cols)
+                else:
+                    # A no-op still tells whether the row is there.
+                    assign = key_columns[0] + ' = ' + key_columns[0]
+                update = 'UPDATE ' + self.name + ' SET ' + assign + \
+                    ' WHERE ' + where
+
+                if mysql and upsert:
+                    command = insert + ' ON DUPLICATE KEY UPDATE ' + \
+                        ', '.join('%s = VALUES(%s)' % (c, c)
+                                  for c in cols or key_columns[:1])
+                    cur.executemany(command, [keys + sets for _, keys, sets
+                                              in group])
+                    for row, _, _ in group:
+                        result[row] = row not in existing
+                elif mysql:
+                    updates = []
+                    inserts = []
+                    for row, row_values, col_values in group:
+                        result[row] = row not in existing
+                        if result[row]:
+                            inserts.append(row_values + col_values)
+                        elif cols:
+                            updates.append(col_values + row_values)
+                    if updates:
+                        cur.executemany(update, updates)
+                    if inserts:
+                        cur.executemany(insert, inserts)
+                else:
+                    # sqlite counts the rows an UPDATE matched, and runs
+                    # in-process, so going row by row is cheap. Inserting
+                    # right away lets a later row which the collation
+                    # considers the same update it instead.
+                    for row, row_values, col_values in group:
+                        cur.execute(update, col_values + row_values)
+                        result[row] = cur.rowcount < 1
+                        if result[row]:
+                            cur.execute(insert, row_values + col_values)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        return result
+
+    def _existing(self, cur, rows, key_columns):
+        """
+        Return the set of ``rows`` which match a row in the table on
+        ``key_columns``, as the database compares them. Each row is looked up
+        in a branch of its own, tagged with its position, so the values are
+        never compared outside the database.
+        """
+        subst = self.db.substitution
+        match = ' AND '.join(k + ' = ' + subst for k in key_columns)
+        if len(key_columns) == 1:
+            key = key_columns[0]
+        else:
+            key = key_columns
+        existing = set()
+        for chunk in self._chunks(rows, key):
+            selects = ['SELECT %d FROM %s WHERE %s' % (i, self.name, match)
+                       for i in xrange(len(chunk))]
+            cur.execute(' UNION ALL '.join(selects),
+                        self._flatten_rows(chunk, key))
+            for (i,) in cur.fetchall():
+                existing.add(chunk[int(i)])
+        return existing
+
     def delete(self, row, key=None):
         """Deletes the row for ``row`` in the database, removing its values in
         all columns."""
@@ -518,8 +1751,61 @@ class Table(object):
         db.close()
         return result
 
+    def iter_rows(self, columns=None, batch_size=None):
+        """
+        Return a generator over the values of ``columns`` in every row of the
+        table. If ``columns`` is a single column name, the values themselves
+        are yielded; otherwise each item is a tuple in the same order as
+        ``columns``. When ``columns`` is not given, every column is included,
+        in alphabetical order.
+
+        Rows are read from the database ``batch_size`` at a time (defaulting
+        to ``fetch_size``) and nothing else is kept, so this uses the same
+        amount of memory however large the table is. The connection is held
+        open until the generator is exhausted or closed.
+        """
+        if not self.columns:  # handle a non-existant table
+            return
+
+        single = isinstance(columns, basestring)
+        if columns is None:
+            columns = sorted(self.columns)
+        elif single:
+            columns = [columns]
+        batch_size = batch_size or self.fetch_size
+
+        db = self.db.connect()
+        try:
+            cur = self.db.streaming_cursor(db)
+            cur.execute('SELECT ' + ', '.join(columns) + ' FROM ' + self.name)
+            while True:
+                batch = cur.fetchmany(batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    if single:
+                        yield row[0]
+                    else:
+                        yield tuple(row)
+            cur.close()
+        finally:
+            db.close()
+
+    def iter_keys(self, key=None, batch_size=None):
+        """
+        Return a generator over the values of the ``key`` column(s), which
+        defaults to the primary key, in every row of the table. For a multi-
+        column key, each item is a tuple. Like ``iter_rows``, this reads the
+        table in batches and runs in constant memory.
+        """
+        if not key:
+            key = self.key
+        if not isinstance(key, basestring):
+            key = list(key)
+        return self.iter_rows(key, batch_size)
+
     def __iter__(self):
-        return self.keys()
+        return self.iter_keys()
 
     def contains(self, row, key=None):
         """
@@ -561,9 +1847,9 @@ class Table(object):
         checks this list, and returns True if it contains ``column``. If
         ``column`` is an iterable, this returns true if all of the values in
         ``column`` are in the column cache. Note that this will not check the
-        database itself; it's meant for speed, not accuracy. However, unless
-        you have multiple bots using the same database, or are adding columns
-        while the bot is running, you are unlikely to encounter errors.
+        database itself; it's meant for speed, not accuracy. Columns added by
+        other bots using the same database show up after the next
+        ``SopelDB.sync``.
         """
         if not self.columns:  # handle a non-existant table
             return False
@@ -576,6 +1862,64 @@ class Table(object):
                 has = col in self.columns and has
             return has
 
+    def add_index(self, columns, name=None, unique=False):
+        """
+        Create a secondary index on the given ``columns``, which may be a
+        single column name or a tuple of them, and add it to the index cache.
+        Indexing a column makes ``get`` and ``get_many`` with ``key`` set to
+        that column look up rows directly, rather than scanning the table.
+
+        If ``name`` is not given, one is made up from the table and column
+        names. If an index on exactly these columns is already cached, no new
+        index is created. Return the name of the index.
+
+        On MySQL, only the first ``index_prefix`` characters of ``TEXT`` and
+        ``BLOB`` columns, such as those made by ``add_columns``, are indexed.
+        A ``unique`` index then only applies to that prefix.
+        """
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+
+        if isinstance(columns, basestring):
+            columns = (columns,)
+        else:
+            columns = tuple(columns)
+        for column in columns:
+            if column not in self.columns:
+                raise ValueError('No column %s in table %s.'
+                                 % (column, self.name))
+        for index, indexed in self.indexes.iteritems():
+            if indexed == columns:
+                return index
+
+        if not name:
+            name = 'idx_%s_%s' % (self.name, '_'.join(columns))
+        if unique:
+            command = 'CREATE UNIQUE INDEX '
+        else:
+            command = 'CREATE INDEX '
+        db = self.db.connect()
+        cur = db.cursor()
+        parts = list(columns)
+        if self.db.type == 'mysql':
+            cur.execute(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS"
+                " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+                " AND DATA_TYPE IN ('tinytext', 'text', 'mediumtext',"
+                " 'longtext', 'tinyblob', 'blob', 'mediumblob', 'longblob');",
+                (self.name,)
+            )
+            unbounded = set(column.lower() for (column,) in cur.fetchall())
+            parts = ['%s(%d)' % (c, self.index_prefix)
+                     if c.lower() in unbounded else c for c in parts]
+        cur.execute(command + name + ' ON ' + self.name +
+                    ' (' + ', '.join(parts) + ');')
+        db.commit()
+        db.close()
+        self.indexes[name] = columns
+        self.db.invalidate('schema')
+        return name
+
     @deprecated
     def addcolumns(self, columns):
         return self.add_columns(columns)
@@ -604,7 +1948,438 @@ class Table(object):
         # Why a second loop? because I don't want clomuns to be added to
         # self.columns if executing the SQL command fails
         for column in columns:
+            if isinstance(column, tuple):
+                column = column[0]
+            self.columns.add(column)
+        self.db.invalidate('schema')
+
+
+def _kv_value(value):
+    """
+    Return ``value`` made of the plain types ``marshal`` can store. Byte
+    strings become unicode, as the SQL backends return them. Subclasses such
+    as ``Nick`` become their base type, since ``marshal`` would otherwise
+    write out their internal buffer. Lists become tuples.
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return str.__str__(value)
+    elif isinstance(value, unicode):
+        if type(value) is not unicode:
+            value = unicode.__getslice__(value, 0, len(value))
+        return value
+    elif isinstance(value, bool) or value is None:
+        return value
+    elif isinstance(value, (int, long, float)):
+        for base in (int, long, float):
+            if isinstance(value, base):
+                return base(value)
+    elif isinstance(value, dict):
+        return dict((_kv_value(k), _kv_value(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_kv_value(v) for v in value)
+    return value
+
+
+class KVTable(Table):
+    """
+    A ``Table`` kept in a ``KVStore`` rather than a SQL database, for SopelDBs
+    of the ``kv`` type. Each row is stored under the value(s) of its key
+    column(s), as a dict of its other columns.
+
+    Lookups by the table's own key go straight to the store's hash index.
+    Passing a different ``key`` to ``get``, ``get_many``, ``update``,
+    ``delete`` or ``contains`` works too, but scans the whole table; indexes
+    added with ``add_index`` are recorded, but not used to speed that up.
+    ``update`` can only create new rows when given the table's own key.
+    """
+
+    def __init__(self, db, name, columns, key, indexes=None):
+        Table.__init__(self, db, name, columns, key, indexes)
+        self._store = KVStore(os.path.join(db._dir, name + '.kv'))
+
+    def _save_schema(self):
+        if isinstance(self.key, basestring):
+            key = [self.key]
+        else:
+            key = list(self.key)
+        path = os.path.join(self.db._dir, self.name + '.schema')
+        with open(path + '.tmp', 'w') as schema:
+            json.dump({'columns': sorted(self.columns), 'key': key,
+                       'indexes': self.indexes}, schema)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _row_key(self, row):
+        if isinstance(self.key, basestring) and not isinstance(row,
+                                                               basestring):
+            if len(row) != 1:
+                raise ValueError('Unequal number of key and row columns.')
+            row = row[0]
+        elif not isinstance(self.key, basestring):
+            if isinstance(row, basestring) or len(row) != len(self.key):
+                raise ValueError('Unequal number of key and row columns.')
+        return _kv_value(row)
+
+    def _full_row(self, row, value):
+        """Return a dict of every column in the stored ``row``."""
+        full = dict(value)
+        if isinstance(self.key, basestring):
+            full[self.key] = row
+        else:
+            full.update(zip(self.key, row))
+        return full
+
+    def _find(self, row, key):
+        """Return the stored keys of the rows where ``key`` matches ``row``."""
+        if isinstance(key, basestring):
+            key, row = [key], [row]
+        match = zip(key, [_kv_value(r) for r in row])
+        found = []
+        for stored, value in self._store.items():
+            full = self._full_row(stored, value)
+            if all(full.get(k) == r for k, r in match):
+                found.append(stored)
+        return found
+
+    def _select(self, row, value, columns):
+        if isinstance(columns, basestring):
+            return self._full_row(row, value).get(columns)
+        full = self._full_row(row, value)
+        return tuple(full.get(c) for c in columns)
+
+    def users(self):
+        if not self.columns:  # handle a non-existant table
+            return 0
+        return sum(1 for k in self.iter_keys() if not self._is_channel(k))
+
+    def channels(self):
+        if not self.columns:  # handle a non-existant table
+            return 0
+        return sum(1 for k in self.iter_keys() if self._is_channel(k))
+
+    def _is_channel(self, row):
+        if not isinstance(row, basestring):
+            row = row[0]
+        return isinstance(row, basestring) and row[:1] in ('#', '&')
+
+    def size(self):
+        if not self.columns:  # handle a non-existant table
+            return 0
+        return len(self._store)
+
+    def get(self, row, columns, key=None):
+        if not self.columns:  # handle a non-existant table
+            return None
+        if key and key != self.key:
+            found = self._find(row, key)
+            if not found:
+                raise KeyError('%s not in database' % (row,))
+            row = found[0]
+        else:
+            row = self._row_key(row)
+        try:
+            value = self._store.get(row)
+        except KeyError:
+            raise KeyError('%s not in database' % (row,))
+        return self._select(row, value, columns)
+
+    def get_many(self, rows, columns, key=None):
+        if not self.columns:  # handle a non-existant table
+            return {}
+        result = {}
+        if key and key != self.key:
+            # One scan finds all of the rows, rather than one scan per row.
+            single = isinstance(key, basestring)
+            wanted = set()
+            for row in rows:
+                if not single and (isinstance(row, basestring) or
+                                   len(row) != len(key)):
+                    raise ValueError('Unequal number of key and row columns.')
+                wanted.add(_kv_value(row if single else tuple(row)))
+            for stored, value in self._store.items():
+                full = self._full_row(stored, value)
+                if single:
+                    row = full.get(key)
+                else:
+                    row = tuple(full.get(k) for k in key)
+                if row in wanted:
+                    result[row] = self._select(stored, value, columns)
+            return result
+        for row in rows:
+            try:
+                row = self._row_key(row)
+                result[row] = self._select(row, self._store.get(row), columns)
+            except KeyError:
+                pass
+        return result
+
+    def _check_columns(self, values):
+        for column in values:
+            if column not in self.columns:
+                raise ValueError('No column %s in table %s.'
+                                 % (column, self.name))
+
+    def _stamp(self, values):
+        if not self.ttl_column or self.ttl_column in values:
+            return values
+        values = dict(values)
+        values[self.ttl_column] = int(time.time())
+        return values
+
+    def _stamp_unset(self):
+        now = int(time.time())
+        self._store.begin()
+        try:
+            for row, value in self._store.items():
+                if value.get(self.ttl_column) is None:
+                    value[self.ttl_column] = now
+                    self._store.put(row, value)
+        finally:
+            self._store.end()
+
+    def expire(self, batch_size=None, max_batches=None):
+        if not self.columns or not self.ttl_column:
+            return 0
+
+        batch_size = int(batch_size or self.expire_batch_size)
+        cutoff = int(time.time() - self.ttl)
+        expired = [row for row, value in self._store.items()
+                   if int(value.get(self.ttl_column) or cutoff) < cutoff]
+        if max_batches is not None:
+            expired = expired[:batch_size * max_batches]
+        for i in xrange(0, len(expired), batch_size):
+            self._store.begin()
+            try:
+                for row in expired[i:i + batch_size]:
+                    try:
+                        self._store.delete(row)
+                    except KeyError:
+                        pass
+            finally:
+                self._store.end()
+        return len(expired)
+
+    def _put(self, row, values):
+        """Merge ``values`` into the stored ``row``; return True if new."""
+        try:
+            value = self._store.get(row)
+            created = False
+        except KeyError:
+            value = {}
+            created = True
+        for column, new in values.iteritems():
+            value[column] = _kv_value(new)
+        self._store.put(row, value)
+        return created
+
+    def update(self, row, values, key=None):
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+        self._check_columns(values)
+        values = self._stamp(values)
+        if key and key != self.key:
+            found = self._find(row, key)
+            if not found:
+                raise KeyError('%s not in database' % (row,))
+            for stored in found:
+                self._put(stored, values)
+        else:
+            self._put(self._row_key(row), values)
+
+    def update_many(self, mapping, key=None):
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+        if key and key != self.key:
+            raise ValueError('update_many on a kv table needs its own key.')
+        result = {}
+        self._store.begin()
+        try:
+            for row, values in mapping.iteritems():
+                self._check_columns(values)
+                result[row] = self._put(self._row_key(row),
+                                        self._stamp(values))
+        finally:
+            self._store.end()
+        return result
+
+    def delete(self, row, key=None):
+        if not self.columns:  # handle a non-existant table
+            raise KeyError('Table is empty.')
+        if key and key != self.key:
+            found = self._find(row, key)
+        else:
+            found = [self._row_key(row)]
+        try:
+            for stored in found:
+                self._store.delete(stored)
+        except KeyError:
+            raise KeyError('%s not in database' % (row,))
+        if not found:
+            raise KeyError('%s not in database' % (row,))
+
+    def keys(self, key=None):
+        if not self.columns:  # handle a non-existant table
+            raise KeyError('Table is empty.')
+        if not key:
+            key = self.key
+        if isinstance(key, basestring):
+            return [(v,) for v in self.iter_rows(key)]
+        return list(self.iter_rows(list(key)))
+
+    def iter_rows(self, columns=None, batch_size=None):
+        if not self.columns:  # handle a non-existant table
+            return
+        if columns is None:
+            columns = sorted(self.columns)
+        elif not isinstance(columns, basestring):
+            columns = list(columns)
+        for row, value in self._store.items():
+            yield self._select(row, value, columns)
+
+    def contains(self, row, key=None):
+        if not self.columns:  # handle a non-existant table
+            return False
+        if key and key != self.key:
+            return bool(self._find(row, key))
+        try:
+            return self._row_key(row) in self._store
+        except (ValueError, TypeError):
+            return False
+
+    def add_columns(self, columns):
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+        for column in columns:
+            if isinstance(column, tuple):
+                column = column[0]
             self.columns.add(column)
+        self._save_schema()
+
+    def add_index(self, columns, name=None, unique=False):
+        if not self.columns:  # handle a non-existant table
+            raise ValueError('Table is empty.')
+        if isinstance(columns, basestring):
+            columns = (columns,)
+        else:
+            columns = tuple(columns)
+        for index, indexed in self.indexes.iteritems():
+            if tuple(indexed) == columns:
+                return index
+        if not name:
+            name = 'idx_%s_%s' % (self.name, '_'.join(columns))
+        self.indexes[name] = columns
+        self._save_schema()
+        return name
+
+
+def migrate(source, target, batch_size=5000):
+    """
+    Copy every table in the SopelDB ``source`` into the SopelDB ``target``,
+    which may be of a different type. Tables are created in ``target`` with
+    the same columns, key and indexes. Any table which already exists there
+    must be empty. Column types are not carried over, so the backend's default
+    string type is used. Tables without a primary key are copied as they are,
+    except to a ``kv`` target, which needs one.
+
+    Rows are streamed from ``source`` and written ``batch_size`` at a time
+    with ``executemany``, so memory use does not grow with the size of the
+    table. Each table is copied in one transaction. If that fails, the table
+    is rolled back and reported, and the others are still copied. On a
+    ``kv`` target, the rows already written are deleted instead. Afterwards
+    the number of rows in each table is compared. Progress is printed as it
+    goes. Return ``True`` if every table was copied in full.
+    """
+    ok = True
+    started = time.time()
+    total = 0
+    for name in sorted(source.tables):
+        table = getattr(source, name)
+        if table.keyless:
+            key = []
+        elif isinstance(table.key, basestring):
+            key = [table.key]
+        else:
+            key = list(table.key)
+        if not key and target.type == 'kv':
+            print 'Skipping table %s: it has no primary key.' % name
+            ok = False
+            continue
+        columns = key + sorted(c for c in table.columns if c not in key)
+        try:
+            target.add_table(name, columns, key and table.key)
+        except ValueError as e:
+            print 'Skipping table %s: %s' % (name, e)
+            ok = False
+            continue
+        target_table = getattr(target, name)
+        if target_table.size():
+            print 'Skipping table %s: it is not empty in the target.' % name
+            ok = False
+            continue
+
+        table_started = time.time()
+        copied = 0
+        rows = table.iter_rows(columns, batch_size)
+        try:
+            with target.transaction() as db:
+                if target.type == 'kv':
+                    width = len(key)
+                    while True:
+                        batch = list(itertools.islice(rows, batch_size))
+                        if not batch:
+                            break
+                        target_table.update_many(dict(
+                            (r[0] if width == 1 else r[:width],
+                             dict(zip(columns[width:], r[width:])))
+                            for r in batch
+                        ))
+                        copied += len(batch)
+                else:
+                    command = 'INSERT INTO ' + name + ' (' + \
+                        ', '.join(columns) + ') VALUES (' + \
+                        ', '.join([target.substitution] * len(columns)) + ')'
+                    cur = db.cursor()
+                    while True:
+                        batch = list(itertools.islice(rows, batch_size))
+                        if not batch:
+                            break
+                        cur.executemany(command, batch)
+                        copied += len(batch)
+        except Exception as e:
+            if target.type == 'kv':
+                for row in target_table._store.keys():
+                    target_table._store.delete(row)
+            print 'Failed to copy table %s, after %d rows: %s' % (
+                name, copied, e)
+            ok = False
+            continue
+        finally:
+            rows.close()
+        # Building the indexes once at the end is faster than updating them
+        # with every batch.
+        for index, indexed in table.indexes.iteritems():
+            target_table.add_index(indexed, index)
+
+        elapsed = max(time.time() - table_started, 0.001)
+        expected = table.size()
+        written = target_table.size()
+        print 'Copied %d rows of %s in %.1fs (%d rows/sec).' % (
+            copied, name, elapsed, copied / elapsed)
+        if written != expected:
+            print 'Row count mismatch for %s: %d in source, %d in target.' % (
+                name, expected, written)
+            ok = False
+        total += copied
+
+    elapsed = max(time.time() - started, 0.001)
+    print 'Copied %d rows in %d tables in %.1fs (%d rows/sec).' % (
+        total, len(source.tables), elapsed, total / elapsed)
+    return ok
 
 
 def configure(config):
@@ -616,7 +2391,8 @@ def configure(config):
 
     config.interactive_add(
         'db', 'userdb_type',
-        'What type of database would you like to use? (sqlite/mysql)', 'sqlite'
+        'What type of database would you like to use? (sqlite/mysql/kv)',
+        'sqlite'
     )
 
     if config.db.userdb_type == 'sqlite':
@@ -624,6 +2400,11 @@ def configure(config):
             'db', 'userdb_file', 'Location for the database file'
         )
 
+    elif config.db.userdb_type == 'kv':
+        config.interactive_add(
+            'db', 'userdb_dir', 'Directory to keep the database files in'
+        )
+
     elif config.db.userdb_type == 'mysql':
         config.interactive_add(
             'db', 'userdb_host', "Enter the MySQL hostname", 'localhost'
@@ -32,33 +32,157 @@ except:
     has_ssl = False
 import errno
 import threading
+from collections import Mapping, Counter
 from datetime import datetime
 from tools import verify_ssl_cn
+import module
+from membership import MembershipStore, PrivilegeView, OPS, HALFPLUS, VOICES
+from isupport import ISupport
+
+
+class MessageTags(Mapping):
+    """
+    A read-only mapping of the IRCv3 message tags on a line to their values,
+    or ``None`` for tags without one. ``raw`` is the tag string as it was
+    sent, without the leading ``@``; it is only split up and unescaped the
+    first time a tag is looked up.
+    """
+
+    __slots__ = ('raw', '_tags')
+
+    _escape = re.compile(r'\\(.?)', re.DOTALL)
+    _escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._tags = None
+
+    def _parse(self):
+        tags = self._tags
+        if tags is not None:
+            return tags
+        tags = {}
+        if self.raw:
+            escapes = self._escapes
+            for tag in self.raw.split(';'):
+                key, _, value = tag.partition('=')
+                if '\\' in value:
+                    # Unknown escapes stand for the character itself, and a
+                    # lone backslash at the end is dropped.
+                    value = self._escape.sub(
+                        lambda m: escapes.get(m.group(1), m.group(1)), value)
+                # An empty value is the same as no value.
+                tags[key] = value or None
+        self._tags = tags
+        return tags
+
+    def __getitem__(self, key):
+        return self._parse()[key]
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __len__(self):
+        return len(self._parse())
+
+    def __contains__(self, key):
+        return key in self._parse()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.raw)
+
+
+no_tags = MessageTags(u'')
+"""The tags of every line which has none."""
+
+
+_unset = object()
+
+
+def _line_target(line):
+    """
+    Return the first argument of the raw ``line``, which is usually the
+    channel or nick it was sent to, or ``None`` if it has none.
+    """
+    words = line.split(' ', 4)
+    i = 0
+    if words[0].startswith('@'):
+        i += 1
+    if len(words) > i and words[i].startswith(':'):
+        i += 1
+    # words[i] is the command.
+    if len(words) > i + 1:
+        return words[i + 1].lstrip(':') or None
+    return None
 
 
 class Origin(object):
+    """
+    Where a line came from. Most lines are never looked at by any handler,
+    so ``nick``, ``user``, ``host`` and ``sender`` are only worked out the
+    first time one of them is read.
+    """
+
+    __slots__ = ('hostmask', 'tags', '_bot', '_target', '_nick', '_user',
+                 '_host', '_sender')
+
     source = re.compile(r'([^!]*)!?([^@]*)@?(.*)')
+    """How a hostmask splits into nick, user and host."""
 
     def __init__(self, bot, source, args, tags):
         self.hostmask = source
         self.tags = tags
-
-        #Split out the nick, user, and host from hostmask per the regex above.
-        match = Origin.source.match(source or '')
-        self.nick, self.user, self.host = match.groups()
-        self.nick = Nick(self.nick)
-
+        self._bot = bot
         # If we have more than one argument, the second one is the sender
-        if len(args) > 1:
-            target = args[1]
-        else:
-            target = None
-
-        # Unless we're messaging the bot directly, in which case that second
-        # arg will be our bot's name.
-        if target and target.lower() == bot.nick.lower():
-            target = self.nick
-        self.sender = target
+        self._target = args[1] if len(args) > 1 else None
+        self._nick = None
+        self._user = None
+        self._host = None
+        self._sender = _unset
+
+    def _split(self):
+        # Split out the nick, user, and host from hostmask, as the regex above
+        # would.
+        nick, _, rest = (self.hostmask or '').partition('!')
+        self._user, _, self._host = rest.partition('@')
+        self._nick = self._bot.memberships.intern(nick)
+
+    @property
+    def nick(self):
+        """The ``Nick`` of whoever sent the line."""
+        if self._nick is None:
+            self._split()
+        return self._nick
+
+    @property
+    def user(self):
+        """The local username of whoever sent the line."""
+        if self._nick is None:
+            self._split()
+        return self._user
+
+    @property
+    def host(self):
+        """The host of whoever sent the line."""
+        if self._nick is None:
+            self._split()
+        return self._host
+
+    @property
+    def sender(self):
+        """
+        The channel the line was sent to, or the nick of whoever sent it if
+        it was sent to the bot directly.
+        """
+        sender = self._sender
+        if sender is _unset:
+            sender = self._target
+            # Unless we're messaging the bot directly, in which case that
+            # second arg will be our bot's name.
+            if sender and sender.lower() == self._bot.nick.lower():
+                sender = self.nick
+            self._sender = sender
+        return sender
 
 
 class Bot(asynchat.async_chat):
@@ -86,6 +210,12 @@ class Bot(asynchat.async_chat):
         self.channels = []
         """The list of channels Sopel is currently in."""
 
+        self.rejoin_channels = []
+        """
+        Channels to join on connecting, besides those in the config. When the
+        bot reconnects, this is the list of channels it was in before.
+        """
+
         self.stack = []
         self.ca_certs = ca_certs
         self.hasquit = False
@@ -94,22 +224,42 @@ class Bot(asynchat.async_chat):
         self.writing_lock = threading.Lock()
         self.raw = None
 
-        #Right now, only accounting for two op levels.
-        #This might be expanded later.
-        #These lists are filled in startup.py, as of right now.
-        self.ops = dict()
+        self.fallback_decodes = Counter()
         """
-        A dictionary mapping channels to a ``Nick`` list of their operators.
+        How many lines which were not valid UTF-8 came from each target, that
+        is the channel or nick they were sent to, or ``None`` for lines
+        without one. Those lines are decoded with the target's charset from
+        the ``channel_charsets`` config option (a list of ``#channel:charset``
+        entries), or else with ``fallback_charset``, which defaults to
+        ``cp1252``.
         """
-        self.halfplus = dict()
+        self.failed_decodes = Counter()
         """
-        A dictionary mapping channels to a ``Nick`` list of their half-ops and
-        ops.
+        How many lines from each target could not be decoded with the
+        fallback charset either. They are decoded with replacement
+        characters instead.
+        """
+        self._charsets = None
+
+        self.memberships = MembershipStore()
+        """
+        The ``MembershipStore`` of the users in each channel the bot is in,
+        and their privileges. It is kept up to date by ``coretasks``.
+        """
+
+        # These are read-only views of memberships, kept for older modules.
+        self.ops = PrivilegeView(self.memberships, OPS)
+        """
+        A mapping of channels to a ``Nick`` set of their operators.
+        """
+        self.halfplus = PrivilegeView(self.memberships, HALFPLUS)
         """
-        self.voices = dict()
+        A mapping of channels to a ``Nick`` set of their half-ops and ops.
         """
-        A dictionary mapping channels to a ``Nick`` list of their voices,
-        half-ops and ops.
+        self.voices = PrivilegeView(self.memberships, VOICES)
+        """
+        A mapping of channels to a ``Nick`` set of their voices, half-ops and
+        ops.
         """
 
         #We need this to prevent error loops in handle_error
@@ -119,6 +269,12 @@ class Bot(asynchat.async_chat):
         """ Set to True when a server has accepted the client connection and
         messages can be sent and received. """
 
+        self.isupport = ISupport()
+        """
+        The ``ISupport`` table of the features the server has advertised on
+        the current connection. It is filled in by ``coretasks``.
+        """
+
     def log_raw(self, line, prefix):
         ''' Log raw line to the raw log '''
         if not self.config.core.log_raw:
@@ -166,7 +322,8 @@ class Bot(asynchat.async_chat):
 
         Newlines and carriage returns ('\\n' and '\\r') are removed before
         sending. Additionally, if the message (after joining) is longer than
-        than 510 characters, any remaining characters will not be sent.
+        the server's line length (510 bytes, unless it advertises a
+        ``LINELEN``), anything past that is not sent.
         """
         args = [self.safe(arg) for arg in args]
         if text is not None:
@@ -186,13 +343,21 @@ class Bot(asynchat.async_chat):
             #including the trailing CR-LF. Thus, there are 510 characters
             #maximum allowed for the command and its parameters.  There is no
             #provision for continuation of message lines.
+            #
+            #The limit is in bytes, so it is applied to the encoded line, and
+            #a character cut in half at the end is dropped.
 
             if text is not None:
-                temp = (u' '.join(args) + ' :' + text)[:510] + '\r\n'
+                temp = u' '.join(args) + ' :' + text
             else:
-                temp = u' '.join(args)[:510] + '\r\n'
-            self.log_raw(temp, '>>')
-            self.send(temp.encode('utf-8'))
+                temp = u' '.join(args)
+            line = temp.encode('utf-8')
+            limit = self.isupport.linelen - 2
+            if len(line) > limit:
+                temp = line[:limit].decode('utf-8', 'ignore')
+                line = temp.encode('utf-8')
+            self.log_raw(temp + '\r\n', '>>')
+            self.send(line + '\r\n')
         finally:
             self.writing_lock.release()
 
@@ -260,6 +425,59 @@ class Bot(asynchat.async_chat):
         else:
             self.write(['JOIN', channel, password])
 
+    def join_many(self, channels):
+        """Join several channels, in as few lines as possible.
+
+        Each item in ``channels`` is a channel name, optionally followed by a
+        space and its key, as in the ``channels`` config option. Channels
+        given more than once are only joined once. They are sent in
+        comma-separated ``JOIN`` lines, each with no more channels than the
+        server's ``TARGMAX`` allows, and no longer than its line length.
+        Channels with keys go first, since the keys are matched up with the
+        channels in order."""
+        keyed = []
+        unkeyed = []
+        seen = set()
+        for channel in channels:
+            name, _, key = channel.strip().partition(' ')
+            folded = self.isupport.lower(name)
+            if not name or folded in seen:
+                continue
+            seen.add(folded)
+            if key.strip():
+                keyed.append((name, key.strip()))
+            else:
+                unkeyed.append((name, None))
+
+        targets = self.isupport.targmax.get('JOIN')
+        # Leave room for "JOIN ", the space before the keys and the CR-LF.
+        room = self.isupport.linelen - len('JOIN  \r\n')
+        names = []
+        keys = []
+        length = 0
+        for name, key in keyed + unkeyed:
+            size = len(name.encode('utf-8')) + 1
+            if key:
+                size += len(key.encode('utf-8')) + 1
+            if names and (length + size > room or
+                          (targets and len(names) >= targets)):
+                self._write_join(names, keys)
+                names = []
+                keys = []
+                length = 0
+            names.append(name)
+            if key:
+                keys.append(key)
+            length += size
+        if names:
+            self._write_join(names, keys)
+
+    def _write_join(self, names, keys):
+        if keys:
+            self.write(('JOIN', ','.join(names), ','.join(keys)))
+        else:
+            self.write(('JOIN', ','.join(names)))
+
     def handle_connect(self):
         if self.config.core.use_ssl and has_ssl:
             if not self.config.core.verify_ssl:
@@ -317,10 +535,15 @@ class Bot(asynchat.async_chat):
                     os._exit(1)
             self.set_socket(self.ssl)
 
+        # What the last server supported may not hold for this one.
+        self.isupport = ISupport()
+        self.memberships.set_casemapping(self.isupport.lower)
+
         # Request list of server capabilities. IRCv3 servers will respond with
         # CAP * LS (which we handle in coretasks). v2 servers will respond with
-        # 421 Unknown command, which we'll ignore
-        self.write(('CAP', 'LS'))
+        # 421 Unknown command, which we'll ignore. Version 302 lets the server
+        # split a long list over several lines, rather than cut it short.
+        self.write(('CAP', 'LS', '302'))
 
         if self.config.core.server_password is not None:
             self.write(('PASS', self.config.core.server_password))
@@ -390,42 +613,31 @@ class Bot(asynchat.async_chat):
                 raise
 
     def collect_incoming_data(self, data):
-        # We can't trust clients to pass valid unicode.
-        try:
-            data = unicode(data, encoding='utf-8')
-        except UnicodeDecodeError:
-            # not unicode, let's try cp1252
-            try:
-                data = unicode(data, encoding='cp1252')
-            except UnicodeDecodeError:
-                # Okay, let's try ISO8859-1
-                try:
-                    data = unicode(data, encoding='iso8859-1')
-                except:
-                    # Discard line if encoding is unknown
-                    return
-
-        if data:
-            self.log_raw(data, '<<')
+        # Reads don't end where lines do, so lines are only decoded once
+        # they're complete, in found_terminator. That way, a character split
+        # across two reads is put back together first.
         self.buffer += data
 
     def found_terminator(self):
         line = self.buffer
         if line.endswith('\r'):
             line = line[:-1]
-        self.buffer = u''
+        self.buffer = ''
+        # We can't trust clients to pass valid unicode.
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            line = self._decode_fallback(line)
+        if line:
+            self.log_raw(line, '<<')
         self.raw = line
 
-        # Break off IRCv3 message tags, if present
-        tags = {}
+        # Break off IRCv3 message tags, if present. They are parsed when, and
+        # if, something looks at them.
+        tags = no_tags
         if line.startswith('@'):
             tagstring, line = line.split(' ', 1)
-            for tag in tagstring[1:].split(';'):
-                tag = tag.split('=', 1)
-                if len(tag) > 1:
-                    tags[tag[0]] = tag[1]
-                else:
-                    tags[tag[0]] = None
+            tags = MessageTags(tagstring[1:])
 
         if line.startswith(':'):
             source, line = line[1:].split(' ', 1)
@@ -454,6 +666,45 @@ class Bot(asynchat.async_chat):
         origin = Origin(self, source, args, tags)
         self.dispatch(origin, text, args)
 
+    def _decode_fallback(self, line):
+        target = _line_target(line)
+        if self._charsets is None:
+            self._charsets = self._load_charsets()
+        default = self._charsets[None]
+        if target is not None:
+            charset = self._charsets.get(target.lower(), default)
+        else:
+            charset = default
+        self.fallback_decodes[target] += 1
+        try:
+            return line.decode(charset)
+        except UnicodeDecodeError:
+            self.failed_decodes[target] += 1
+            return line.decode(charset, 'replace')
+
+    def _load_charsets(self):
+        # Maps each lower-case target to its charset, and None to the default.
+        charsets = {None: 'cp1252'}
+        entries = [(None, self.config.core.fallback_charset or 'cp1252')]
+        for entry in self.config.core.get_list('channel_charsets'):
+            entry = entry.strip()
+            if not entry:
+                continue
+            target, _, charset = entry.rpartition(':')
+            if not target:
+                stderr('channel_charsets entry %r is not target:charset, '
+                       'ignoring it.' % entry)
+                continue
+            entries.append((target.lower(), charset))
+        for target, charset in entries:
+            try:
+                codecs.lookup(charset)
+            except LookupError:
+                stderr('Unknown charset %r in config, ignoring it.' % charset)
+                continue
+            charsets[target] = charset
+        return charsets
+
     def dispatch(self, origin, text, args):
         pass
 
@@ -588,7 +839,7 @@ class Bot(asynchat.async_chat):
         logfile.write('last raw line was %s' % self.raw)
         logfile.write(trace)
         logfile.write('Buffer:\n')
-        logfile.write(self.buffer)
+        logfile.write(self.buffer.decode('utf-8', 'replace'))
         logfile.write('----------------------------------------\n\n')
         logfile.close()
         if self.error_count > 10:
@@ -601,48 +852,31 @@ class Bot(asynchat.async_chat):
             os._exit(1)
 
     #Helper functions to maintain the oper list.
-    #They cast to Nick when adding to be quite sure there aren't any accidental
-    #string nicks. On deletion, you know you'll never need to worry about what
-    #the real superclass is, so we just cast and remove.
+    #These are kept for older modules; they just change privileges in the
+    #membership store, which the ops, halfplus and voices views reflect.
     def add_op(self, channel, name):
-        if isinstance(name, Nick):
-            self.ops[channel].add(name)
-        else:
-            self.ops[channel].add(Nick(name))
+        self.memberships.add_privileges(channel, name, module.OP)
 
     def add_halfop(self, channel, name):
-        if isinstance(name, Nick):
-            self.halfplus[channel].add(name)
-        else:
-            self.halfplus[channel].add(Nick(name))
+        self.memberships.add_privileges(channel, name, module.HALFOP)
 
     def add_voice(self, channel, name):
-        if isinstance(name, Nick):
-            self.voices[channel].add(name)
-        else:
-            self.voices[channel].add(Nick(name))
+        self.memberships.add_privileges(channel, name, module.VOICE)
 
     def del_op(self, channel, name):
-        self.ops[channel].discard(Nick(name))
+        self.memberships.remove_privileges(channel, name, OPS)
 
     def del_halfop(self, channel, name):
-        self.halfplus[channel].discard(Nick(name))
+        self.memberships.remove_privileges(channel, name, module.HALFOP)
 
     def del_voice(self, channel, name):
-        self.voices[channel].discard(Nick(name))
+        self.memberships.remove_privileges(channel, name, module.VOICE)
 
     def flush_ops(self, channel):
-        self.ops[channel] = set()
-        self.halfplus[channel] = set()
-        self.voices[channel] = set()
+        self.memberships.clear_privileges(channel)
 
     def init_ops_list(self, channel):
-        if not channel in self.halfplus:
-            self.halfplus[channel] = set()
-        if not channel in self.ops:
-            self.ops[channel] = set()
-        if not channel in self.voices:
-            self.voices[channel] = set()
+        self.memberships.add_channel(channel)
 
 
 if __name__ == "__main__":
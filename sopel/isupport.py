@@ -0,0 +1,151 @@
+# coding=utf-8
+"""
+isupport.py - Server feature advertisements
+Licensed under the Eiffel Forum License 2.
+
+Servers advertise what they support in ``RPL_ISUPPORT`` (``005``) lines of
+``NAME=value`` tokens, such as which channel modes exist and take arguments,
+which prefixes mark privileged users, and how nicks are compared. An
+``ISupport`` holds those tokens for one connection, along with the values
+derived from them which the rest of the bot needs.
+"""
+
+import re
+
+import module
+
+_escape = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+mode_privileges = {'v': module.VOICE,
+                   'h': module.HALFOP,
+                   'o': module.OP,
+                   'a': module.ADMIN,
+                   'q': module.OWNER}
+"""Maps the channel modes which give privileges to the privileges they give."""
+
+_casemaps = {
+    'ascii': (u'ABCDEFGHIJKLMNOPQRSTUVWXYZ', u'abcdefghijklmnopqrstuvwxyz'),
+    'rfc1459': (u'ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                u'abcdefghijklmnopqrstuvwxyz{}|^'),
+    'strict-rfc1459': (u'ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\',
+                       u'abcdefghijklmnopqrstuvwxyz{}|'),
+}
+# Turn each pair into a table for unicode.translate.
+for _name, (_upper, _lower) in _casemaps.items():
+    _casemaps[_name] = dict(zip(map(ord, _upper), map(ord, _lower)))
+del _name, _upper, _lower
+
+
+class ISupport(dict):
+    """
+    The ``RPL_ISUPPORT`` tokens sent by the server, as a dict of each token's
+    name to its value, or ``None`` for tokens with no value. Until the server
+    sends any, the values below are the usual defaults.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.prefixes = {}
+        """Maps each prefix used in NAMES replies to its privileges."""
+        self.prefix_modes = {}
+        """Maps each prefix mode, such as ``o``, to its privileges."""
+        self.chanmodes = ('', '', '', '')
+        """
+        The channel modes of each type in ``CHANMODES``: those which manage a
+        list, those which always take an argument, those which only take one
+        when set, and those which never take one.
+        """
+        self.chantypes = '#&'
+        """The characters which channel names may start with."""
+        self.casemapping = 'rfc1459'
+        """How the server compares nicks and channel names."""
+        self.modes = 3
+        """How many modes with an argument may be changed in one MODE line."""
+        self.targmax = {}
+        """
+        Maps commands to how many targets each may be given at once, or
+        ``None`` for no limit. Commands not listed have no known limit.
+        """
+        self.linelen = 512
+        """The longest line the server accepts, counting the CR-LF."""
+        self._update()
+
+    def parse(self, tokens):
+        """
+        Add the ``tokens`` of an ``RPL_ISUPPORT`` line, without the first
+        argument (our nick) and the final text, to the table. A token starting
+        with ``-`` withdraws a token sent earlier.
+        """
+        for token in tokens:
+            if token.startswith('-'):
+                self.pop(token[1:], None)
+                continue
+            name, _, value = token.partition('=')
+            if value:
+                value = _escape.sub(lambda m: unichr(int(m.group(1), 16)),
+                                    value)
+            self[name] = value or None
+        self._update()
+
+    def _update(self):
+        prefix = self.get('PREFIX') or '(qaohv)~&@%+'
+        match = re.match(r'\((\w*)\)(.*)', prefix)
+        if match and len(match.group(1)) == len(match.group(2)):
+            modes, prefixes = match.groups()
+        else:
+            modes, prefixes = '', ''
+        self.prefix_modes = dict((mode, mode_privileges.get(mode, 0))
+                                 for mode in modes)
+        self.prefixes = dict((char, mode_privileges.get(mode, 0))
+                             for mode, char in zip(modes, prefixes))
+
+        chanmodes = (self.get('CHANMODES') or 'beI,k,l,imnpst').split(',')
+        self.chanmodes = tuple((chanmodes + ['', '', ''])[:4])
+        self.chantypes = self.get('CHANTYPES') or '#&'
+
+        self.casemapping = (self.get('CASEMAPPING') or 'rfc1459').lower()
+        self._casemap = _casemaps.get(self.casemapping, _casemaps['ascii'])
+        self.modes = _int(self.get('MODES'), 3)
+        self.linelen = _int(self.get('LINELEN'), 512)
+
+        self.targmax = {}
+        for target in (self.get('TARGMAX') or '').split(','):
+            command, _, limit = target.partition(':')
+            if command:
+                self.targmax[command.upper()] = _int(limit, None)
+
+    def lower(self, name):
+        """Return ``name`` in lower case, as the server's casemapping does."""
+        if not isinstance(name, unicode):
+            name = name.decode('utf-8')
+        return name.translate(self._casemap)
+
+    def parse_modes(self, modes, args):
+        """
+        Split the channel ``modes`` of a ``MODE`` line, such as ``+ov-b``, and
+        pair them with the given ``args``. Return a list of ``(sign, mode,
+        argument)`` tuples, where ``argument`` is ``None`` for modes which do
+        not take one here. Whether a mode takes an argument is decided by
+        ``PREFIX`` and ``CHANMODES``.
+        """
+        lists, always, when_set, never = self.chanmodes
+        args = iter(args)
+        result = []
+        sign = '+'
+        for mode in modes:
+            if mode in '+-':
+                sign = mode
+                continue
+            if (mode in self.prefix_modes or mode in lists or
+                    mode in always or (sign == '+' and mode in when_set)):
+                result.append((sign, mode, next(args, None)))
+            else:
+                result.append((sign, mode, None))
+        return result
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,321 @@
+# coding=utf-8
+"""
+kvstore.py - Embedded key-value storage for the settings database
+Licensed under the Eiffel Forum License 2.
+
+This is the storage behind the ``kv`` type of ``SopelDB``. Each store is a
+single append-only log file. Every record in the log either sets a key to a
+value or deletes a key, so the latest record for a key wins. An in-memory hash
+index maps each live key to where its value sits in the file, and values are
+read through a memory map of the log, so a lookup is a dict access, a slice and
+a ``marshal.loads``.
+
+Records written since the log was last mapped are also kept in memory, and
+read from there. The map is only renewed once they add up to ``remap_step``
+bytes, so a read following a write does not have to map the file again.
+
+As keys are overwritten and deleted, the log accumulates dead records. Once
+they take up more than ``compact_ratio`` of a log bigger than ``compact_min``
+bytes, the live records are copied to a new log which replaces the old one.
+This happens on a thread of its own, and the store can be read and written
+while the copy is made.
+
+Keys and values are serialized with ``marshal``, so they may be made of
+unicode strings, numbers, ``None``, and tuples and dicts of those. A store can
+only be opened by one process at a time. Where ``fcntl`` is available, this is
+enforced with a lock on a ``.lock`` file next to the log.
+"""
+
+import os
+import mmap
+import struct
+import marshal
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_header = struct.Struct('>BII')
+"""Each record starts with its type, and the lengths of its key and value."""
+_PUT = 1
+_DELETE = 2
+
+
+class StoreLockedError(Exception):
+    """
+    Raised when opening a ``KVStore`` which is already open in another
+    process.
+    """
+
+
+class KVStore(object):
+    """
+    Open the append-only key-value log at ``path``, creating it if needed,
+    and build its index.
+    """
+
+    compact_min = 1 << 20
+    """Logs smaller than this many bytes are never compacted."""
+    compact_ratio = 0.5
+    """The fraction of the log which may be dead records before compaction."""
+    remap_step = 1 << 20
+    """How many bytes may be written before the log is mapped again."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compacting = False
+        self._closed = False
+        self._batch = 0
+        self._lockfile = open(path + '.lock', 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lockfile.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lockfile.close()
+                raise StoreLockedError('%s is open in another process.'
+                                       % path)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'ab+')
+        self._index = {}
+        self._dead = 0
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        self._remap()
+
+        # Rebuild the index by replaying the log.
+        offset = 0
+        end = self._size
+        data = self._map
+        while offset + _header.size <= end:
+            kind, klen, vlen = _header.unpack_from(data, offset)
+            start = offset + _header.size
+            if start + klen + vlen > end:
+                break
+            key = marshal.loads(data[start:start + klen])
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._dead += _header.size + klen + old[1]
+            if kind == _PUT:
+                self._index[key] = (start + klen, vlen)
+            else:
+                self._dead += _header.size + klen
+            offset = start + klen + vlen
+        if offset != end:
+            # A write was cut short, probably by a crash. Drop the partial
+            # record, so the next one is appended where it should be.
+            self._file.truncate(offset)
+            self._size = offset
+            self._remap()
+
+    def _remap(self):
+        self._file.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        self._mapped = self._size
+        self._tail = bytearray()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        """Return the value for ``key``, or raise ``KeyError``."""
+        with self._lock:
+            offset, length = self._index[key]
+            if offset < self._mapped:
+                data = self._map[offset:offset + length]
+            else:
+                offset -= self._mapped
+                data = str(self._tail[offset:offset + length])
+        return marshal.loads(data)
+
+    def keys(self):
+        """Return a list of every key in the store."""
+        return self._index.keys()
+
+    def items(self):
+        """
+        Return a generator over the key and value of each entry. Entries
+        changed after the generator is created may or may not be included.
+        """
+        for key in self.keys():
+            try:
+                yield key, self.get(key)
+            except KeyError:
+                pass
+
+    def _append(self, kind, kbytes, vbytes):
+        record = _header.pack(kind, len(kbytes), len(vbytes)) + \
+            kbytes + vbytes
+        self._file.write(record)
+        self._tail += record
+        offset = self._size + _header.size + len(kbytes)
+        self._size += len(record)
+        if not self._batch:
+            self._file.flush()
+            if len(self._tail) >= self.remap_step:
+                self._remap()
+        return offset
+
+    def put(self, key, value):
+        """Set ``key`` to ``value``."""
+        kbytes = marshal.dumps(key)
+        vbytes = marshal.dumps(value)
+        with self._lock:
+            old = self._index.get(key)
+            if old is not None:
+                self._dead += _header.size + len(kbytes) + old[1]
+            offset = self._append(_PUT, kbytes, vbytes)
+            self._index[key] = (offset, len(vbytes))
+            self._maybe_compact()
+
+    def delete(self, key):
+        """Remove ``key``, or raise ``KeyError`` if it is not present."""
+        kbytes = marshal.dumps(key)
+        with self._lock:
+            old = self._index.pop(key)
+            self._append(_DELETE, kbytes, '')
+            self._dead += 2 * _header.size + 2 * len(kbytes) + old[1]
+            self._maybe_compact()
+
+    def begin(self):
+        """
+        Start a batch of writes, which are not flushed to the file until the
+        matching ``end``. Batches may be nested.
+        """
+        with self._lock:
+            self._batch += 1
+
+    def end(self):
+        """Finish a batch of writes started with ``begin``, and flush them."""
+        with self._lock:
+            self._batch -= 1
+            if not self._batch:
+                self._file.flush()
+                if len(self._tail) >= self.remap_step:
+                    self._remap()
+                self._maybe_compact()
+
+    def _maybe_compact(self):
+        if (not self._batch and not self._compacting and
+                self._size > self.compact_min and
+                self._dead > self._size * self.compact_ratio):
+            self._compacting = True
+            thread = threading.Thread(target=self.compact,
+                                      name='KVStore compaction')
+            thread.daemon = True
+            thread.start()
+
+    def compact(self):
+        """
+        Rewrite the log with only its live records. The store stays usable
+        while this runs, except for a short pause at the end.
+        """
+        with self._compact_lock:
+            try:
+                if not self._closed:
+                    self._compact()
+            finally:
+                self._compacting = False
+
+    def _compact(self):
+        with self._lock:
+            self._file.flush()
+            end = self._size
+            dead = self._dead
+            # Copy in file order, so the disk is read sequentially.
+            live = sorted(self._index.iteritems(), key=lambda item: item[1])
+
+        # The log is only ever appended to, so everything before ``end`` stays
+        # as it is while it is copied, without holding the lock.
+        tmp_path = self.path + '.tmp'
+        copied = {}
+        size = 0
+        log = open(self.path, 'rb')
+        tmp = open(tmp_path, 'wb')
+        try:
+            data = ''
+            if end:
+                data = mmap.mmap(log.fileno(), end, access=mmap.ACCESS_READ)
+            try:
+                for key, (offset, length) in live:
+                    kbytes = marshal.dumps(key)
+                    tmp.write(_header.pack(_PUT, len(kbytes), length))
+                    tmp.write(kbytes)
+                    tmp.write(data[offset:offset + length])
+                    size += _header.size + len(kbytes)
+                    copied[key] = (size, length)
+                    size += length
+            finally:
+                if end:
+                    data.close()
+
+            self._lock.acquire()
+            try:
+                # Carry over whatever was written during the copy as it is.
+                # The records it made dead are just as dead in the new log.
+                self._file.flush()
+                log.seek(end)
+                tmp.write(log.read(self._size - end))
+                tmp.flush()
+                os.fsync(tmp.fileno())
+                log.close()
+                tmp.close()
+
+                index = {}
+                for key, (offset, length) in self._index.iteritems():
+                    if offset >= end:
+                        index[key] = (offset - end + size, length)
+                    else:
+                        index[key] = copied[key]
+                dead = self._dead - dead
+                self._close()
+                if os.name == 'nt':
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+                self._file = open(self.path, 'ab+')
+                self._size = os.fstat(self._file.fileno()).st_size
+                self._index = index
+                self._dead = dead
+                self._remap()
+            finally:
+                self._lock.release()
+        finally:
+            log.close()
+            tmp.close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def flush(self):
+        """Make sure every write so far has been handed to the OS."""
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        """
+        Flush and close the store, once any compaction running has finished.
+        It must not be used afterwards.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                self._closed = True
+                self._close()
+                self._lockfile.close()
@@ -0,0 +1,503 @@
+# coding=utf-8
+"""
+membership.py - Channel membership tracking
+Licensed under the Eiffel Forum License 2.
+
+The bot keeps one ``MembershipStore`` of which nicks are in each of its
+channels, and with what privileges. The privileges are the bitwise flags from
+``module`` (``VOICE``, ``HALFOP``, ``OP``, ``ADMIN`` and ``OWNER``), so each
+membership costs one dict entry whose value is a small, shared int. Every
+``Nick`` is interned, so a user in many channels is stored once, and the store
+keeps an index of the channels each nick is in, so a ``QUIT`` or ``NICK`` only
+touches the channels the user was actually in.
+
+``intern`` looks nicks up by the string the server sent first, and then by
+that string folded with the server's casemapping, so the nicks of tracked
+users are never rebuilt, and comparing or hashing them in the store's dicts
+finds the very same object. Only nicks in a tracked channel are interned, so
+the cache shrinks as users leave. Every nick the store looks up is folded the
+same way, and those nicks compare with each other by that fold, rather than
+the RFC 1459 one of ``Nick``, so the store's dicts and its index of nicks
+always agree on who is who. They still hash as ``Nick`` does, so a plain
+``Nick`` finds its user in ``privileges`` as it always has.
+
+When a server splits from the network, everyone on it quits at once, and
+rejoins in a burst when the split heals. ``split_quit`` and ``join`` buffer
+those events, and they are applied together, under one lock, by ``flush`` or
+by the next other change to the store. Until then, ``privileges`` still shows
+the users as they were.
+
+The older ``ops``, ``halfplus`` and ``voices`` attributes of the bot are
+read-only views of the store, made with ``PrivilegeView``.
+
+The store also keeps a ``User`` for every nick it tracks, with their user,
+host, account and away message as far as they are known. With the IRCv3
+``extended-join``, ``account-notify``, ``away-notify`` and
+``userhost-in-names`` capabilities, the server sends all of those as they
+change, so the bot never has to ask for them with ``WHO`` or ``WHOIS``.
+"""
+
+import time
+import threading
+from collections import Mapping, Set
+
+import module
+from tools import Nick
+from isupport import ISupport
+
+OPS = module.OP | module.ADMIN | module.OWNER
+"""The privileges which count as ``ops``."""
+HALFPLUS = OPS | module.HALFOP
+"""The privileges which count as ``halfplus``."""
+VOICES = HALFPLUS | module.VOICE
+"""The privileges which count as ``voices``."""
+
+
+class User(object):
+    """
+    What the store knows about one user. Each field is ``None`` until it is
+    known: ``user`` and ``host`` are the parts of their hostmask, ``account``
+    is the services account they are logged in to, and ``away`` is their away
+    message.
+    """
+
+    __slots__ = ('user', 'host', 'account', 'away')
+
+    def __init__(self):
+        self.user = None
+        self.host = None
+        self.account = None
+        self.away = None
+
+    def __repr__(self):
+        return '%s(%r, %r, %r, %r)' % (self.__class__.__name__, self.user,
+                                       self.host, self.account, self.away)
+
+
+class MembershipStore(object):
+    """
+    Tracks the users of each channel, and their privileges there. Reading
+    ``privileges`` is safe from any thread; changes must go through the
+    methods of the store, which keep the interned nicks in step.
+    """
+
+    split_expiry = 3600
+    """
+    How many seconds after a netsplit the ``join`` of a nick lost in it is
+    still buffered.
+    """
+
+    def __init__(self):
+        self.privileges = dict()
+        """
+        A dict mapping each channel to a dict of the ``Nick`` of each user in
+        it to a bitwise integer of their privileges, made by combining the
+        appropriate constants from ``module``. It must not be changed
+        directly.
+        """
+        self.users = dict()
+        """
+        A dict mapping the ``Nick`` of each user in any tracked channel to
+        their ``User``. It must not be changed directly.
+        """
+        self._nicks = dict()
+        # Maps each interned Nick, folded by the server's casemapping, to the
+        # Nick.
+        self._raw = dict()
+        # Maps each interned Nick, as a plain string, to the Nick.
+        self._lower = ISupport().lower
+        self._channels = dict()
+        # Maps each interned Nick to the set of channels it is in.
+        self._pending = []
+        # Buffered netsplit events, as (channel, nick, info) for a JOIN, with
+        # the info given to join, or (None, nick, None) for a QUIT.
+        self._split = dict()
+        # Maps the nicks lost in netsplits to when they quit.
+        self._names = dict()
+        # Maps each channel to the roster, and the hosts, of a NAMES reply in
+        # progress.
+        self._lock = threading.Lock()
+
+    def intern(self, nick):
+        """
+        Return the ``Nick`` object the store uses for ``nick``, if it holds
+        one, or ``nick`` as a ``Nick`` folded by the server's casemapping
+        otherwise.
+        """
+        if not isinstance(nick, Nick):
+            tracked = self._raw.get(nick)
+            if tracked is not None:
+                return tracked
+        key = self._lower(nick)
+        tracked = self._nicks.get(key)
+        if tracked is None:
+            return _TrackedNick(nick, key)
+        return tracked
+
+    def set_casemapping(self, lower):
+        """
+        Fold nicks with ``lower``, a function such as ``ISupport.lower``, from
+        now on. It should follow the casemapping the server advertises.
+        """
+        with self._lock:
+            self._lower = lower
+            self._nicks = dict()
+            for nick in self._channels:
+                nick._key = lower(nick)
+                self._nicks[nick._key] = nick
+            # The nicks of buffered netsplit events, and of NAMES replies in
+            # progress, need not be tracked. They all hash as Nick does, so
+            # the dicts keyed by them need not be rebuilt.
+            for _, nick, _ in self._pending:
+                nick._key = lower(nick)
+            for nick in self._split:
+                nick._key = lower(nick)
+            for roster, hosts in self._names.itervalues():
+                for nick in roster:
+                    nick._key = lower(nick)
+                for nick in hosts:
+                    nick._key = lower(nick)
+
+    def _track(self, nick):
+        key = self._lower(nick)
+        tracked = self._nicks.get(key)
+        if tracked is None:
+            tracked = self._nicks[key] = _TrackedNick(nick, key)
+            self._raw[unicode(nick)] = tracked
+        return tracked
+
+    def _forget(self, nick):
+        if self._nicks.pop(self._lower(nick), None) is not None:
+            self._raw.pop(unicode(nick), None)
+
+    def channels(self, nick):
+        """Return a list of the channels ``nick`` is in."""
+        return list(self._channels.get(self.intern(nick), ()))
+
+    def _ref(self, nick, channel):
+        nick = self._track(nick)
+        channels = self._channels.get(nick)
+        if channels is None:
+            channels = self._channels[nick] = set()
+            self.users[nick] = User()
+        channels.add(channel)
+        return nick
+
+    def _unref(self, nick, channel):
+        channels = self._channels.get(nick)
+        if channels is None:
+            return
+        channels.discard(channel)
+        if not channels:
+            del self._channels[nick]
+            self._forget(nick)
+            self.users.pop(nick, None)
+
+    def add_channel(self, channel):
+        """Start tracking ``channel``, if it is not already tracked."""
+        with self._lock:
+            self._flush()
+            if channel not in self.privileges:
+                self.privileges[channel] = dict()
+
+    def remove_channel(self, channel):
+        """Forget ``channel`` and everyone in it."""
+        with self._lock:
+            self._flush()
+            for nick in self.privileges.pop(channel, ()):
+                self._unref(nick, channel)
+
+    def set_privileges(self, channel, nick, privileges=0):
+        """
+        Record that ``nick`` is in ``channel`` with the given ``privileges``,
+        replacing any they had. The channel is tracked if it was not already.
+        """
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            self._set(channel, nick, privileges)
+
+    def _set(self, channel, nick, privileges):
+        users = self.privileges.setdefault(channel, dict())
+        if nick not in users:
+            nick = self._ref(nick, channel)
+        users[nick] = privileges
+
+    def add_privileges(self, channel, nick, privileges):
+        """
+        Give ``nick`` the ``privileges`` in ``channel``, on top of those they
+        already have. Untracked channels are ignored.
+        """
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            users = self.privileges.get(channel)
+            if users is None:
+                return
+            if nick not in users:
+                nick = self._ref(nick, channel)
+            users[nick] = users.get(nick, 0) | privileges
+
+    def remove_privileges(self, channel, nick, privileges):
+        """Take the ``privileges`` in ``channel`` away from ``nick``."""
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            users = self.privileges.get(channel)
+            if users is not None and nick in users:
+                users[nick] &= ~privileges
+
+    def clear_privileges(self, channel):
+        """Take away every privilege from everyone in ``channel``."""
+        with self._lock:
+            self._flush()
+            users = self.privileges.get(channel)
+            if users is not None:
+                for nick in users:
+                    users[nick] = 0
+
+    def add_names(self, channel, roster, hosts=None):
+        """
+        Add ``roster``, a dict of ``Nick`` to privileges from one line of a
+        NAMES reply for ``channel``, to that reply's roster. ``hosts`` may map
+        some of those nicks to their ``(user, host)``, as sent by servers with
+        ``userhost-in-names``. Nothing changes until ``end_names``.
+        """
+        with self._lock:
+            names = self._names.get(channel)
+            if names is None:
+                names = self._names[channel] = (dict(), dict())
+            names[0].update(roster)
+            if hosts:
+                names[1].update(hosts)
+
+    def end_names(self, channel):
+        """
+        Replace the users of ``channel``, and their privileges, with the
+        roster of the NAMES reply which has just ended. The channel is
+        tracked if it was not already.
+        """
+        with self._lock:
+            self._flush()
+            names = self._names.pop(channel, None)
+            if names is None:
+                return
+            roster, hosts = names
+            for nick in self.privileges.get(channel, ()):
+                if nick not in roster:
+                    self._unref(nick, channel)
+            users = dict()
+            for nick, privileges in roster.iteritems():
+                users[self._ref(nick, channel)] = privileges
+            # Swap the whole roster in at once, so readers never see it half
+            # built.
+            self.privileges[channel] = users
+            for nick, (user, host) in hosts.iteritems():
+                self._identify(nick, user, host, None)
+
+    def part(self, channel, nick):
+        """Record that ``nick`` has left ``channel``."""
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            users = self.privileges.get(channel)
+            if users is not None and nick in users:
+                del users[nick]
+                self._unref(nick, channel)
+
+    def quit(self, nick):
+        """Record that ``nick`` has left every channel."""
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            self._quit(nick)
+
+    def _quit(self, nick):
+        for channel in self._channels.pop(nick, ()):
+            self.privileges[channel].pop(nick, None)
+        self._forget(nick)
+        self.users.pop(nick, None)
+
+    def split_quit(self, nick):
+        """
+        Record that ``nick`` was lost in a netsplit. The ``QUIT`` is buffered,
+        and so are the nick's JOINs for the next ``split_expiry`` seconds.
+        """
+        nick = self.intern(nick)
+        with self._lock:
+            self._pending.append((None, nick, None))
+            self._split[nick] = time.time()
+
+    def join(self, channel, nick, user=None, host=None, account=None):
+        """
+        Record that ``nick`` has joined ``channel``, with no privileges, from
+        the given ``user`` and ``host``. With ``extended-join``, the JOIN also
+        gives the ``account`` they are logged in to, or ``*`` for none. While
+        netsplit events are buffered, or if ``nick`` was lost in a recent
+        netsplit, the ``JOIN`` is buffered too.
+        """
+        nick = self.intern(nick)
+        info = (user, host, account)
+        with self._lock:
+            if self._pending or nick in self._split:
+                self._pending.append((channel, nick, info))
+            else:
+                self._set(channel, nick, 0)
+                self._identify(nick, *info)
+
+    def flush(self):
+        """
+        Apply the buffered netsplit events, and return how many there were.
+        """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        pending = self._pending
+        if not pending:
+            return 0
+        self._pending = []
+        for channel, nick, info in pending:
+            if channel is None:
+                self._quit(nick)
+            else:
+                self._set(channel, nick, 0)
+                self._identify(nick, *info)
+
+        cutoff = time.time() - self.split_expiry
+        for nick, when in self._split.items():
+            if when < cutoff:
+                del self._split[nick]
+        return len(pending)
+
+    def rename(self, old, new):
+        """Record that ``old`` is now known as ``new``, keeping privileges."""
+        old = self.intern(old)
+        if not isinstance(new, Nick):
+            new = Nick(new)
+        with self._lock:
+            self._flush()
+            channels = self._channels.pop(old, None)
+            if not channels:
+                return
+            # Drop the old Nick first, in case only its case is changing.
+            self._forget(old)
+            user = self.users.pop(old, None) or User()
+            new = self._track(new)
+            self.users[new] = user
+            for channel in channels:
+                users = self.privileges[channel]
+                users[new] = users.pop(old)
+            self._channels.setdefault(new, set()).update(channels)
+
+    def _identify(self, nick, user, host, account):
+        info = self.users.get(nick)
+        if info is None:
+            return
+        if host is not None:
+            info.user = user
+            info.host = host
+        if account is not None:
+            info.account = None if account == '*' else account
+
+    def set_host(self, nick, user, host):
+        """Record the ``user`` and ``host`` of ``nick``, if it is tracked."""
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            self._identify(nick, user, host, None)
+
+    def set_account(self, nick, account):
+        """
+        Record the services ``account`` which ``nick`` is logged in to, if it
+        is tracked. An account of ``*`` or ``None`` means they logged out.
+        """
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            self._identify(nick, None, None, account or '*')
+
+    def set_away(self, nick, message):
+        """
+        Record the away ``message`` of ``nick``, if it is tracked, or that
+        they are back if it is ``None``.
+        """
+        nick = self.intern(nick)
+        with self._lock:
+            self._flush()
+            info = self.users.get(nick)
+            if info is not None:
+                info.away = message
+
+
+class _TrackedNick(Nick):
+    """
+    A ``Nick`` as a ``MembershipStore`` looks it up, which compares with
+    others like it by ``_key``, its fold under the server's casemapping.
+    Compared to anything else, it is an ordinary ``Nick``. It hashes as one
+    too, since no casemapping folds more than RFC 1459 does, so nicks with
+    the same ``_key`` always hash alike.
+    """
+
+    def __new__(cls, nick, key):
+        self = Nick.__new__(cls, nick)
+        self._key = key
+        return self
+
+    def __hash__(self):
+        return Nick.__hash__(self)
+
+    def __eq__(self, other):
+        if isinstance(other, _TrackedNick):
+            return self._key == other._key
+        return Nick.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class PrivilegeView(Mapping):
+    """
+    A read-only mapping of each channel in ``store`` to a set-like view of
+    the nicks there with any of the privileges in ``mask``. It reflects the
+    store as it changes.
+    """
+
+    def __init__(self, store, mask):
+        self._store = store
+        self._mask = mask
+
+    def __getitem__(self, channel):
+        return _NickView(self._store, self._store.privileges[channel],
+                         self._mask)
+
+    def __iter__(self):
+        return iter(self._store.privileges)
+
+    def __len__(self):
+        return len(self._store.privileges)
+
+
+class _NickView(Set):
+    def __init__(self, store, users, mask):
+        self._store = store
+        self._users = users
+        self._mask = mask
+
+    def __contains__(self, nick):
+        nick = self._store.intern(nick)
+        return bool(self._users.get(nick, 0) & self._mask)
+
+    def __iter__(self):
+        mask = self._mask
+        return (nick for nick, privileges in self._users.items()
+                if privileges & mask)
+
+    def __len__(self):
+        mask = self._mask
+        return sum(1 for privileges in self._users.itervalues()
+                   if privileges & mask)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
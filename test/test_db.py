@@ -0,0 +1,172 @@
+# coding=utf-8
+"""Tests for the settings database."""
+import os
+
+import pytest
+
+from sopel.config import Config
+from sopel.db import DBTimeoutError, SopelDB, migrate
+from sopel.kvstore import StoreLockedError
+from sopel.tools import Nick
+
+
+def make_config(tmpdir, db_section):
+    path = tmpdir.join('test.cfg')
+    path.write('[core]\nnick = Sopel\nowner = Owner\nhost = localhost\n'
+               'logdir = %s\n[db]\n%s' % (tmpdir, db_section))
+    return Config(str(path))
+
+
+@pytest.fixture
+def kv_config(tmpdir):
+    return make_config(tmpdir, 'userdb_type = kv\nuserdb_dir = %s\n'
+                       % os.path.join(str(tmpdir), 'kv'))
+
+
+def test_kv_nick_key_survives_reopen(kv_config):
+    db = SopelDB(kv_config)
+    db.add_table('prefs', ['name', 'tz'], 'name')
+    db.prefs.update(Nick(u'Alice'), {'tz': Nick(u'UTC')})
+    db.close()
+
+    db = SopelDB(kv_config)
+    assert list(db.prefs.iter_keys()) == [u'Alice']
+    assert db.prefs.get(u'Alice', 'tz') == u'UTC'
+    assert type(db.prefs.get(u'Alice', 'tz')) is unicode
+
+
+def test_kv_store_open_twice_is_refused(kv_config):
+    db = SopelDB(kv_config)
+    db.add_table('prefs', ['name', 'tz'], 'name')
+    with pytest.raises(StoreLockedError):
+        SopelDB(kv_config)
+    db.close()
+    SopelDB(kv_config)
+
+
+def test_close_waits_for_queued_calls(kv_config):
+    db = SopelDB(kv_config)
+    db.add_table('prefs', ['name', 'tz'], 'name')
+    future = db.submit(db.prefs.update, u'Alice', {'tz': u'UTC'})
+    db.close()
+    assert future.done()
+    db.close()
+
+    db = SopelDB(kv_config)
+    assert db.prefs.get(u'Alice', 'tz') == u'UTC'
+
+
+@pytest.fixture
+def sqlite_config(tmpdir):
+    return make_config(tmpdir, 'userdb_type = sqlite\nuserdb_file = %s\n'
+                       % os.path.join(str(tmpdir), 'test.db'))
+
+
+def test_invalidate_keeps_changes_from_other_bots(sqlite_config):
+    a = SopelDB(sqlite_config)
+    a.add_table('prefs', ['name', 'tz'], 'name')
+    b = SopelDB(sqlite_config)
+    b.prefs.add_columns(['color'])
+    a.prefs.add_index('tz')
+    assert a.sync() == ['schema']
+    assert 'color' in a.prefs.columns
+
+
+def test_metrics_count_connection_shortcuts(sqlite_config):
+    db = SopelDB(sqlite_config)
+    db.metrics.reset()
+    with db.connect() as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS notes (id INTEGER)')
+        conn.executemany('INSERT INTO notes VALUES (?)', [(1,), (2,)])
+    conn.close()
+    assert 'IF' not in db.metrics.tables
+    assert db.metrics.tables['notes']['writes'] == 2
+    assert db.metrics.tables['notes']['rows'] == 2
+
+
+def test_aborted_sqlite_query_times_out(sqlite_config):
+    db = SopelDB(sqlite_config)
+
+    def count():
+        cur = db.connect().cursor()
+        cur.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                    'SELECT i + 1 FROM n) SELECT count(*) FROM n')
+        return cur.fetchone()
+    future = db.submit(count, timeout=0.1)
+    assert isinstance(future.exception(timeout=30), DBTimeoutError)
+    db.close()
+
+
+def test_update_many_lets_the_database_match_rows(sqlite_config):
+    db = SopelDB(sqlite_config)
+    conn = db.connect()
+    conn.execute('CREATE TABLE prefs (name TEXT PRIMARY KEY COLLATE NOCASE,'
+                 ' tz TEXT)')
+    conn.execute("INSERT INTO prefs VALUES ('Bob', 'UTC')")
+    conn.commit()
+    conn.close()
+    db = SopelDB(sqlite_config)
+
+    result = db.prefs.update_many({u'bob': {'tz': u'CET'},
+                                   u'Carol': {'tz': u'EST'}})
+    assert result == {u'bob': False, u'Carol': True}
+    assert db.prefs.get(u'Bob', 'tz') == u'CET'
+    assert db.prefs.size() == 2
+
+
+def test_migrate_copies_keyless_tables(tmpdir, sqlite_config):
+    source = SopelDB(sqlite_config)
+    conn = source.connect()
+    conn.execute('CREATE TABLE log (nick TEXT, line TEXT)')
+    conn.executemany('INSERT INTO log VALUES (?, ?)',
+                     [(u'alice', u'hi'), (u'alice', u'hi again')])
+    conn.commit()
+    conn.close()
+    source = SopelDB(sqlite_config)
+    target_dir = tmpdir.join('target')
+    os.mkdir(str(target_dir))
+    target = SopelDB(make_config(target_dir,
+                                 'userdb_type = sqlite\nuserdb_file = %s\n'
+                                 % target_dir.join('test.db')))
+
+    assert migrate(source, target)
+    assert target.log.keyless
+    assert target.log.size() == 2
+
+
+def test_migrate_rolls_back_a_failed_table(tmpdir, sqlite_config):
+    source = SopelDB(sqlite_config)
+    conn = source.connect()
+    # sqlite lets NULLs into a primary key which is not an INTEGER one, but
+    # the target's key is NOT NULL.
+    conn.execute('CREATE TABLE prefs (name TEXT PRIMARY KEY, tz TEXT)')
+    conn.executemany('INSERT INTO prefs VALUES (?, ?)',
+                     [(u'alice', u'UTC'), (None, u'CET')])
+    conn.commit()
+    conn.close()
+    source = SopelDB(sqlite_config)
+    target_dir = tmpdir.join('target')
+    os.mkdir(str(target_dir))
+    target = SopelDB(make_config(target_dir,
+                                 'userdb_type = sqlite\nuserdb_file = %s\n'
+                                 % target_dir.join('test.db')))
+
+    assert not migrate(source, target, batch_size=1)
+    assert target.prefs.size() == 0
+
+
+def test_get_many_by_another_key_matches_sqlite(kv_config, sqlite_config):
+    results = []
+    for config in (kv_config, sqlite_config):
+        db = SopelDB(config)
+        db.add_table('prefs', ['name', 'tz', 'lang'], 'name')
+        db.prefs.update_many({u'Alice': {'tz': u'UTC', 'lang': u'en'},
+                              u'Bob': {'tz': u'CET', 'lang': u'de'},
+                              u'Carol': {'tz': u'UTC', 'lang': u'fr'}})
+        results.append((db.prefs.get_many([u'de', u'fr', u'nl'], 'name',
+                                          'lang'),
+                        db.prefs.get_many([(u'CET', u'de')], ['name'],
+                                          ['tz', 'lang'])))
+        db.close()
+    assert results[0] == results[1]
+    assert results[0][0] == {u'de': u'Bob', u'fr': u'Carol'}
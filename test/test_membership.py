@@ -0,0 +1,65 @@
+# coding=utf-8
+"""Tests for channel membership tracking."""
+from sopel import coretasks
+from sopel.isupport import ISupport
+from sopel.membership import MembershipStore
+from sopel.tools import Nick
+
+
+def test_ascii_casemapping_keeps_rfc1459_lookalikes_apart():
+    isupport = ISupport()
+    isupport.parse(['CASEMAPPING=ascii'])
+    store = MembershipStore()
+    store.set_casemapping(isupport.lower)
+
+    store.join('#channel', 'Nick[away]')
+    store.join('#channel', 'nick{away}')
+    store.add_privileges('#channel', 'NICK[AWAY]', 4)
+    assert sorted(store.privileges['#channel'].values()) == [0, 4]
+    assert len(store.users) == 2
+
+    store.quit('nick{away}')
+    assert store.privileges['#channel'].items() == [(u'Nick[away]', 4)]
+    assert store.channels('nick[away]') == ['#channel']
+
+
+def test_case_only_nick_change_renames_the_user():
+    class Bot(object):
+        nick = Nick(u'Sopel')
+        memberships = MembershipStore()
+
+    class Trigger(unicode):
+        nick = Nick(u'bob')
+
+    bot = Bot()
+    bot.memberships.join('#channel', 'bob')
+    coretasks.track_nicks(bot, Trigger(u'Bob'))
+    nicks = bot.memberships.privileges['#channel'].keys()
+    assert [unicode(nick) for nick in nicks] == [u'Bob']
+    assert unicode(bot.memberships.intern('BOB')) == u'Bob'
+
+
+def test_plain_nicks_find_tracked_users():
+    store = MembershipStore()
+    store.set_casemapping(ISupport().lower)
+    store.join('#channel', 'Foo[x]')
+    store.add_privileges('#channel', 'foo{X}', 4)
+    assert Nick(u'Foo[x]') in store.privileges['#channel']
+    assert store.privileges['#channel'][Nick(u'FOO{X}')] == 4
+    assert Nick(u'foo{x}') in store.users
+
+
+def test_casemapping_change_rekeys_the_netsplit_buffer():
+    store = MembershipStore()
+    store.join('#channel', 'Nick[away]')
+    store.split_quit('Nick[away]')
+    assert store.flush() == 1
+    isupport = ISupport()
+    isupport.parse(['CASEMAPPING=ascii'])
+    store.set_casemapping(isupport.lower)
+
+    # Still lost in the split, so the JOIN waits for the rest of the burst.
+    store.join('#channel', 'NICK[AWAY]')
+    assert store.privileges['#channel'] == {}
+    assert store.flush() == 1
+    assert store.channels('nick[away]') == ['#channel']